@@ -32,14 +32,399 @@ input_micro_mobility = "Divvy_Trips_20240103.csv"
 input_boundaries = "Boundaries_-_Wards__2023-__20240103.csv"
 
 # Reading Files as dataframes
+import numpy as np
 import pandas as pd
-df_micro_mobility = pd.read_csv(input_micro_mobility, on_bad_lines = 'warn', sep=',')
+
+# The trips file has more than 21M rows and reading it at once with default dtypes (object/float64) runs out of memory.
+# So I am reading it in chunks, only with the columns that each stage needs and with compact dtypes:
+# station IDs fit in int32, coordinates in float32 and GENDER / USER TYPE only have a few values (categoricals).
+TRIP_DTYPES = {
+    "TRIP ID": "int64",
+    "START TIME": "object",
+    "STOP TIME": "object",
+    "BIKE ID": "int32",
+    "TRIP DURATION": "float32",
+    "FROM STATION ID": "int32",
+    "FROM STATION NAME": "object",
+    "TO STATION ID": "int32",
+    "TO STATION NAME": "object",
+    "USER TYPE": pd.CategoricalDtype(["Customer", "Dependent", "Subscriber"]),
+    "GENDER": pd.CategoricalDtype(["Female", "Male"]),
+    "BIRTH YEAR": "float32",
+    "FROM LATITUDE": "float32",
+    "FROM LONGITUDE": "float32",
+    "FROM LOCATION": "object",
+    "TO LATITUDE": "float32",
+    "TO LONGITUDE": "float32",
+    "TO LOCATION": "object",
+}
+
+# Columns that each stage of the analysis reads from the trips file
+TRIP_COLUMNS = {
+    "eda": ["START TIME", "BIKE ID", "USER TYPE", "GENDER", "BIRTH YEAR"],
+    "od": ["START TIME", "BIRTH YEAR", "FROM STATION ID", "TO STATION ID",
+           "FROM LATITUDE", "FROM LONGITUDE", "TO LATITUDE", "TO LONGITUDE"],
+    "utilization": ["START TIME", "STOP TIME", "BIKE ID", "TRIP DURATION"],
+}
+
+# The columns that a trip needs in order to be located (see the data cleaning below)
+COORDINATE_COLUMNS = ["FROM LATITUDE", "TO LATITUDE"]
+
+# Function for streaming the trips file chunk by chunk
+# Only `columns` are parsed (all of them if None) and, if `clean` is True, the rows without coordinates are dropped
+# from every chunk, so the peak memory depends on `chunksize` and not on the size of the file.
+def read_trips_in_chunks(path, columns=None, chunksize=1_000_000, clean=True):
+    read_columns = columns
+    if columns is not None and clean:
+        read_columns = list(dict.fromkeys(list(columns) + COORDINATE_COLUMNS))
+    dtypes = {c: t for c, t in TRIP_DTYPES.items() if read_columns is None or c in read_columns}
+
+    reader = pd.read_csv(path, usecols=read_columns, dtype=dtypes, chunksize=chunksize,
+                         on_bad_lines='warn', sep=',')
+    for chunk in reader:
+        if clean:
+            chunk = chunk.dropna(subset=COORDINATE_COLUMNS)
+            if columns is not None:
+                chunk = chunk[list(columns)]
+        yield chunk
+
+# Memoization of the expensive stages of the analysis (loading, cleaning, ward join, OD matrices, utilization).
+# The output of a stage is saved on disk under a key that is the hash of the stage (name and code of its function) and of
+# all its inputs and parameters, so a re-run only recomputes the stages whose inputs changed:
+# - a file or folder is hashed by the size and modification time of its files, or by the keys of the stages that wrote it
+#   (see StageCache.store) as long as its files were not changed since,
+# - a DataFrame/Series/array is hashed by its content, and the output of a previous stage by the key that produced it,
+# - a function by its code, its default arguments and the globals that it reads (parameters such as REQUIRED_RULES and the
+#   functions and classes that it calls, which are hashed in the same way), so editing a helper or a parameter changes the key,
+# - other parameters (lists, dicts, numbers, ...) by their value.
+# The least recently used outputs are deleted when the cache grows over `max_bytes`.
+# The outputs of the stages must not be modified in place after they are returned (pass them to another stage instead), so
+# the stage functions add their columns to a shallow copy of their input (df.copy(deep=False) shares the data of the columns).
+import os
+import hashlib
+import inspect
+import json
+import pickle
+import types
+import weakref
+
+STAGE_CACHE = "stage_cache"
+
+class StageCache:
+    def __init__(self, path=STAGE_CACHE, max_bytes=20 * 2**30):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._outputs = {}
+        self._target = None
+        os.makedirs(path, exist_ok=True)
+
+    def __call__(self, stage, function, *args, **kwargs):
+        key = self.key(stage, function, *args, **kwargs)
+        path = os.path.join(self.path, f"{key}.pkl")
+        if os.path.exists(path):
+            os.utime(path)
+            with open(path, "rb") as cached:
+                output = pickle.load(cached)
+        else:
+            output = function(*args, **kwargs)
+            with open(path + ".tmp", "wb") as cached:
+                pickle.dump(output, cached, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(path + ".tmp", path)
+            self.evict()
+
+        try:
+            self._outputs[id(output)] = (weakref.ref(output), key)
+        except TypeError:
+            pass
+        return output
+
+    # Run a stage that writes the folder (or file) `path` instead of returning an output, e.g. the trip store or the Parquet cache.
+    # The keys of the stages that wrote `path` are recorded with the status of its files: the stage is skipped when it already
+    # wrote `path` with the same key and the files were not changed since, so the stages that read `path` keep their keys.
+    # A stage that runs again drops the records of the stages that wrote to `path` after it (their files may be overwritten).
+    # Returns True when the stage ran.
+    def store(self, stage, path, function, *args, **kwargs):
+        # `path` is only hashed by its name in the key of the stage that writes it (e.g. as a default argument)
+        self._target = os.path.abspath(path)
+        try:
+            key = self.key(stage, function, *args, **kwargs)
+        finally:
+            self._target = None
+        stores = self._stores()
+        record = stores.get(os.path.abspath(path))
+        if record is None or record["files"] != self._file_status(path):
+            record = {"stages": {}}
+        elif record["stages"].get(stage) == key:
+            return False
+
+        function(*args, **kwargs)
+        stages = record["stages"]
+        if stage in stages:
+            stages = dict(list(stages.items())[:list(stages).index(stage)])
+        stores[os.path.abspath(path)] = {"stages": {**stages, stage: key}, "files": self._file_status(path)}
+        with open(os.path.join(self.path, "_stores.json.tmp"), "w") as stores_file:
+            json.dump(stores, stores_file)
+        os.replace(os.path.join(self.path, "_stores.json.tmp"), os.path.join(self.path, "_stores.json"))
+        return True
+
+    def _stores(self):
+        try:
+            with open(os.path.join(self.path, "_stores.json")) as stores_file:
+                return json.load(stores_file)
+        except FileNotFoundError:
+            return {}
+
+    # Hash of the size and modification time of the files of a file or folder (None when it does not exist)
+    @staticmethod
+    def _file_status(path):
+        if not os.path.exists(path):
+            return None
+        digest = hashlib.sha256()
+        files = [path] if os.path.isfile(path) else sorted(
+            os.path.join(folder, name) for folder, _, names in os.walk(path) for name in names)
+        for file in files:
+            status = os.stat(file)
+            digest.update(f"{file}:{status.st_size}:{status.st_mtime_ns}".encode())
+        return digest.hexdigest()
+
+    def key(self, stage, function, *args, **kwargs):
+        digest = hashlib.sha256(stage.encode())
+        self._hashed_code = set()
+        self._update(digest, function)
+        self._update(digest, args)
+        self._update(digest, kwargs)
+        return digest.hexdigest()
+
+    def _update(self, digest, value):
+        output = self._outputs.get(id(value))
+        if output is not None and output[0]() is value:
+            digest.update(b"stage:" + output[1].encode())
+        elif isinstance(value, pd.DataFrame):
+            digest.update(b"frame")
+            self._update(digest, value.index)
+            for column, values in value.items():
+                self._update(digest, column)
+                self._update(digest, values)
+        elif isinstance(value, (pd.Series, pd.Index)):
+            digest.update(f"{type(value).__name__}:{value.dtype}:{value.name}".encode())
+            if isinstance(value.dtype, pd.CategoricalDtype):
+                self._update(digest, value.cat.codes.to_numpy() if isinstance(value, pd.Series) else value.codes)
+                self._update(digest, value.cat.categories if isinstance(value, pd.Series) else value.categories)
+            elif isinstance(value.dtype, np.dtype) and value.dtype != object:
+                self._update(digest, value.to_numpy())
+            else:
+                digest.update(pd.util.hash_pandas_object(value, index=False).to_numpy().tobytes())
+        elif isinstance(value, np.ndarray):
+            digest.update(f"array:{value.dtype}:{value.shape}".encode())
+            if value.dtype == object:
+                digest.update(pd.util.hash_array(value.ravel()).tobytes())
+            else:
+                digest.update(np.ascontiguousarray(value).reshape(-1).view(np.uint8).data)
+        elif isinstance(value, str) and os.path.abspath(value) == self._target:
+            digest.update(f"target:{value}".encode())
+        elif isinstance(value, str) and os.path.exists(value):
+            digest.update(f"file:{value}".encode())
+            status = self._file_status(value)
+            record = self._stores().get(os.path.abspath(value))
+            if record is not None and record["files"] == status:
+                digest.update(json.dumps(record["stages"]).encode())
+            else:
+                digest.update(status.encode())
+        elif isinstance(value, dict):
+            digest.update(b"dict")
+            for item in sorted(value.items(), key=lambda item: repr(item[0])):
+                self._update(digest, item)
+        elif isinstance(value, (list, tuple)):
+            digest.update(f"{type(value).__name__}:{len(value)}".encode())
+            for item in value:
+                self._update(digest, item)
+        elif inspect.isroutine(value) or inspect.isclass(value):
+            self._update_code(digest, value)
+        elif hasattr(value, "__dict__"):
+            digest.update(type(value).__qualname__.encode())
+            self._update(digest, vars(value))
+        else:
+            digest.update(repr(value).encode())
+
+    # A function is hashed by its source, its default arguments and the globals and closure variables that it reads (modules
+    # excepted), and a class by its source and its attributes, so that the helpers are followed until every code is hashed once.
+    # Only the code of this analysis is followed; functions and classes of the libraries are hashed by their name.
+    def _update_code(self, digest, value):
+        value = getattr(value, "__func__", value)
+        if getattr(value, "__module__", None) != __name__:
+            digest.update(f"code:{getattr(value, '__module__', None)}.{getattr(value, '__qualname__', repr(value))}".encode())
+            return
+        if id(value) in self._hashed_code:
+            digest.update(f"code:{getattr(value, '__qualname__', '')}".encode())
+            return
+        self._hashed_code.add(id(value))
+        try:
+            digest.update(inspect.getsource(value).encode())
+        except (OSError, TypeError):
+            digest.update(getattr(value, "__qualname__", repr(value)).encode())
+
+        if inspect.isclass(value):
+            for name, attribute in sorted(vars(value).items()):
+                attribute = getattr(attribute, "__func__", attribute)
+                if inspect.isfunction(attribute) or not name.startswith("__"):
+                    self._update(digest, (name, attribute))
+        elif inspect.isfunction(value):
+            self._update(digest, (value.__defaults__ or (), value.__kwdefaults__ or {}))
+            variables = inspect.getclosurevars(value)
+            for name, variable in sorted({**variables.globals, **variables.nonlocals}.items()):
+                if not isinstance(variable, types.ModuleType):
+                    self._update(digest, (name, variable))
+
+    # Delete the least recently used outputs until the cache is smaller than `max_bytes`
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.path):
+            if name.endswith(".pkl"):
+                status = os.stat(os.path.join(self.path, name))
+                entries.append((status.st_mtime, status.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            os.remove(os.path.join(self.path, name))
+            total -= size
+
+    def clear(self):
+        for name in os.listdir(self.path):
+            os.remove(os.path.join(self.path, name))
+
+stage_cache = StageCache()
+
+# ...........................................................................................
+
+# Bulk download of the trips from the City of Chicago Data Portal (instead of sodapy, which returns the rows as one list).
+# The dataset is paged with the Socrata parameters ($limit, $offset and $order=:id for a stable order) by a pool of threads
+# sharing one HTTP session, and every page is written as its own Parquet file as soon as it arrives. A page file is only
+# renamed into place when it is complete, so an interrupted download is resumed by running it again: only the missing
+# pages are fetched. Every `where` filter (e.g. the trips after a START TIME) gets its own folder in the store.
+pip install requests
+import json
+import shutil
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+SOCRATA_URL = "https://data.cityofchicago.org"
+DIVVY_DATASET = "fg6s-gzvg"
+SOCRATA_STORE = "socrata_trips"
+
+# Function for converting the JSON records of one page to the columns and dtypes of the trips file
+# (Socrata fields are lower case with underscores, numbers come as strings and the locations as GeoJSON points)
+def socrata_page_frame(records):
+    page = pd.DataFrame.from_records(records)
+    page = page.drop(columns=[c for c in page.columns if c.startswith(":")])
+    page.columns = [c.upper().replace("_", " ") for c in page.columns]
+    for column in page.columns:
+        dtype = TRIP_DTYPES.get(column, "object")
+        if column in ("START TIME", "STOP TIME"):
+            page[column] = pd.to_datetime(page[column]).astype("datetime64[s]")
+        elif column.endswith("LOCATION"):
+            page[column] = [f"POINT ({p['coordinates'][0]} {p['coordinates'][1]})" if isinstance(p, dict) else None
+                            for p in page[column]]
+        elif isinstance(dtype, str) and dtype != "object":
+            page[column] = pd.to_numeric(page[column]).astype(dtype)
+        else:
+            page[column] = page[column].astype(dtype)
+    return page
+
+def socrata_session(app_token=None, workers=8):
+    session = requests.Session()
+    retries = Retry(total=5, backoff_factor=1, status_forcelist=[429, 500, 502, 503, 504])
+    session.mount("http://", HTTPAdapter(pool_maxsize=workers, max_retries=retries))
+    session.mount("https://", HTTPAdapter(pool_maxsize=workers, max_retries=retries))
+    if app_token is not None:
+        session.headers["X-App-Token"] = app_token
+    return session
+
+# Function for downloading the rows of `dataset` that match `where` (a SoQL condition, all the rows if None) into `store`
+# It returns the folder of the pages, which can be read with read_socrata_trips, or None when no rows match (empty pulls are
+# not kept, so that the same `where` counts the rows again next time). The last START TIME of a finished pull is kept in
+# its state (_pull.json) for the cutoff of the next incremental pull.
+def fetch_trips(store=SOCRATA_STORE, where=None, base_url=SOCRATA_URL, dataset=DIVVY_DATASET, app_token=None,
+                page_size=50_000, workers=8, timeout=300):
+    folder = os.path.join(store, "pull-" + hashlib.sha1((where or "").encode()).hexdigest()[:12])
+    os.makedirs(folder, exist_ok=True)
+    url = f"{base_url.rstrip('/')}/resource/{dataset}.json"
+    filters = {"$where": where} if where else {}
+
+    session = socrata_session(app_token, workers)
+    state_path = os.path.join(folder, "_pull.json")
+    if os.path.exists(state_path):
+        # A resumed download keeps the number of rows and the page size of its first run, so the pages stay the same
+        with open(state_path) as state_file:
+            state = json.load(state_file)
+    else:
+        response = session.get(url, params={"$select": "count(*) AS count", **filters}, timeout=timeout)
+        response.raise_for_status()
+        state = {"where": where, "rows": int(response.json()[0]["count"]), "page_size": page_size}
+        if state["rows"] == 0:
+            session.close()
+            shutil.rmtree(folder)
+            return None
+        with open(state_path, "w") as state_file:
+            json.dump(state, state_file)
+
+    def fetch_page(offset):
+        response = session.get(url, params={"$limit": state["page_size"], "$offset": offset, "$order": ":id", **filters},
+                               timeout=timeout)
+        response.raise_for_status()
+        path = os.path.join(folder, f"page-{offset:012d}.parquet")
+        socrata_page_frame(response.json()).to_parquet(path + ".tmp", index=False)
+        os.replace(path + ".tmp", path)
+        return path
+
+    offsets = [offset for offset in range(0, state["rows"], state["page_size"])
+               if not os.path.exists(os.path.join(folder, f"page-{offset:012d}.parquet"))]
+    with session, ThreadPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(fetch_page, offsets))
+
+    if "last_start" not in state:
+        pages = [os.path.join(folder, name) for name in os.listdir(folder) if name.endswith(".parquet")]
+        state["last_start"] = max(pd.read_parquet(page, columns=["START TIME"])["START TIME"].max() for page in pages).isoformat()
+        with open(state_path, "w") as state_file:
+            json.dump(state, state_file)
+    return folder
+
+# Function for downloading only the trips that started after the last START TIME already in `store`
+# The pages of a pull are fetched in parallel, so an interrupted pull can have later pages without the earlier ones:
+# the unfinished pulls (without a last START TIME in their state) are resumed first, otherwise the new cutoff would skip
+# the rows of their missing pages.
+def fetch_new_trips(store=SOCRATA_STORE, **kwargs):
+    last_start = None
+    if os.path.exists(store):
+        for folder in sorted(os.listdir(store)):
+            state_path = os.path.join(store, folder, "_pull.json")
+            if not os.path.exists(state_path):
+                continue
+            with open(state_path) as state_file:
+                state = json.load(state_file)
+            if "last_start" not in state:
+                fetch_trips(store, where=state["where"], **kwargs)
+                with open(state_path) as state_file:
+                    state = json.load(state_file)
+            last_start = max(last_start or state["last_start"], state["last_start"])
+    where = None if last_start is None else f"start_time > '{pd.Timestamp(last_start):%Y-%m-%dT%H:%M:%S}'"
+    return fetch_trips(store, where=where, **kwargs)
+
+# Function for reading the downloaded trips (all the pulls of the store)
+def read_socrata_trips(store=SOCRATA_STORE, columns=None):
+    pages = sorted(os.path.join(folder, name) for folder, _, names in os.walk(store) for name in names if name.endswith(".parquet"))
+    return pd.concat([pd.read_parquet(page, columns=columns) for page in pages], ignore_index=True)
+
+#fetch_trips(app_token="#APP_TOKEN")
+
 df_boundaries = pd.read_csv(input_boundaries, on_bad_lines = 'warn', sep=',')
 
 # Showing a few rows of the tables
 
 # Micro Mobolity
-df_micro_mobility.head()
+next(read_trips_in_chunks(input_micro_mobility, chunksize=5, clean=False))
 
 # Boundaries
 df_boundaries.head()
@@ -56,7 +441,12 @@ df_boundaries.head()
 # - Are there any trends based on the gender and age of the user ?
 
 # Using count() method to see the missing values in schema of the dataframe.
-df_micro_mobility.count()
+# The raw file is counted chunk by chunk, so it never has to be in memory at once, and the counts are memoized like the loading.
+def count_raw_trips(path):
+    return sum(chunk.count() for chunk in read_trips_in_chunks(path, clean=False))
+
+raw_counts = stage_cache("raw counts", count_raw_trips, input_micro_mobility)
+raw_counts
 
 # ...........................................................................................
 
@@ -64,7 +454,12 @@ df_micro_mobility.count()
 # As observed, prior to data cleaning, there are 21,242,740 rows (TRIP ID). However, it is evident that certain columns contain missing values (LATITUDE, LONGITUDE, GENDER, BIRTH YEAR), requiring attention. The most important column for us to calculate OD matrix in further sections are LATITUDE and LONGITUDE, so in this level I am cleaning data based on these columns, however I will clean data based on GENDER and BIRTH YEAR separately. Various approaches exist for handling missing data, and for this exercise, I have decided to address it by removing the rows with missing values.
 
 # Removing null values
-df_MM_clean = df_micro_mobility.dropna(subset=["FROM LATITUDE", "TO LATITUDE"])
+# The chunks are already cleaned by the loader, so only the cleaned rows (and the columns of the analysis stages) are kept in memory.
+analysis_columns = list(dict.fromkeys(TRIP_COLUMNS["eda"] + TRIP_COLUMNS["od"] + TRIP_COLUMNS["utilization"]))
+def load_clean_trips(path, columns):
+    return pd.concat(read_trips_in_chunks(path, columns=columns), ignore_index=True)
+
+df_MM_clean = stage_cache("load", load_clean_trips, input_micro_mobility, columns=analysis_columns)
 df_MM_clean.count()
 
 # Following the data cleaning process, the dataset now consists of 21,241,850 rows for each column, and all necessary columns are non-null except for "GENDER" and "BIRTH YEAR". 
@@ -73,26 +468,52 @@ df_MM_clean.count()
 
 # - When did collection of data start(start-date and time) for micro-mobility dataset and what is the most recent date and time available.
 
-# Turning "Start Time" column to datetime object
-df_MM_clean_time = pd.to_datetime(df_MM_clean['START TIME'], format="%m/%d/%Y %I:%M:%S %p")
-
-# Find the minimum value in the "Start Time" column
-print("Minimum Start Time:", df_MM_clean_time.min())
-
-# Collection of data start(start-date and time) for micro-mobility dataset starts from 01:06:00 of 27th of June 2013.
-print("Most Recent Start Time:", df_MM_clean_time.max())
-
-# The most recent date and time available in dataset is 23:57:17 of 31st December 2019.
-
-# ...........................................................................................
-
-# - Number of records per year and month in micro-mobility dataset.
-
-# Create new columns that we need for further analysis (Year, Season, Month, Week, etc.)
-import datetime as dt
-df_MM_clean["YEAR"] = df_MM_clean_time.dt.strftime("%Y")
-
-df_MM_clean["MONTH"] = df_MM_clean_time.dt.strftime("%m")
+# Turning "Start Time" and "Stop Time" columns to datetime objects
+# These columns are parsed only once here and kept as datetimes in the cleaned data (and in the cache), so the next sections do not parse them again.
+TIME_FORMAT = "%m/%d/%Y %I:%M:%S %p"
+
+# Function for parsing Divvy timestamps (e.g. "06/27/2013 01:06:00 AM")
+# All the timestamps have the same fixed-width layout, so the digits are read directly from the bytes of the strings with NumPy.
+# The values that do not follow this layout are parsed by pd.to_datetime, and columns that are already datetimes are returned as they are.
+def parse_divvy_time(values):
+    values = pd.Series(values)
+    if pd.api.types.is_datetime64_any_dtype(values):
+        return values
+
+    text = np.frombuffer(values.to_numpy(dtype='S22').tobytes(), dtype='uint8').reshape(-1, 22)
+
+    def number(first, last):
+        result = np.zeros(len(text), dtype='int64')
+        for position in range(first, last):
+            result = result * 10 + (text[:, position].astype('int64') - 48)
+        return result
+
+    month, day, year = number(0, 2), number(3, 5), number(6, 10)
+    hour, minute, second = number(11, 13), number(14, 16), number(17, 19)
+    valid = ((text[:, 2] == ord('/')) & (text[:, 5] == ord('/')) & (text[:, 13] == ord(':')) & (text[:, 16] == ord(':'))
+             & np.isin(text[:, 20], [ord('A'), ord('P')]) & (text[:, 21] == ord('M'))
+             & (month >= 1) & (month <= 12) & (day >= 1) & (day <= 31) & (hour >= 1) & (hour <= 12)
+             & (minute >= 0) & (minute < 60) & (second >= 0) & (second < 60) & (year >= 1970))
+
+    # 12 AM is midnight and 12 PM is noon
+    hour = hour % 12 + 12 * (text[:, 20] == ord('P'))
+    months = ((year - 1970) * 12 + month - 1).astype('datetime64[M]')
+    days = months.astype('datetime64[D]').astype('int64') + day - 1
+    # Days past the end of the month (e.g. 02/30) would roll over into the next month
+    valid &= days.astype('datetime64[D]').astype('datetime64[M]') == months
+    parsed = pd.Series((days * 86400 + hour * 3600 + minute * 60 + second).astype('datetime64[s]'),
+                       index=values.index, name=values.name)
+
+    if not valid.all():
+        parsed[~valid] = pd.to_datetime(values[~valid], format=TIME_FORMAT)
+    return parsed
+
+# Function for turning datetimes into int64 epoch seconds (integers are returned as they are)
+def epoch_seconds(values):
+    values = pd.Series(values)
+    if pd.api.types.is_datetime64_any_dtype(values):
+        return values.to_numpy().astype('datetime64[s]').astype('int64')
+    return values.to_numpy(dtype='int64')
 
 # Function for seasons
 def get_season(month):
@@ -105,29 +526,378 @@ def get_season(month):
     else:
         return 'Winter'
 
-df_MM_clean["SEASON"] = df_MM_clean_time.dt.month.apply(get_season)
+SEASONS = ['Winter', 'Spring', 'Summer', 'Autumn']
+DAYS_OF_WEEK = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
+
+# Instead of calling functions like get_season for every row, the groups of an integer feature (month, hour, age, ...) are
+# computed once for every possible value and stored in a lookup table, so labelling all the trips is a single vectorized take.
+
+# Binning of an integer feature into labelled groups
+# table[value] is the position of the group of `value` in `labels` (-1 for no group); values above the table get its last entry.
+class Binning:
+    def __init__(self, table, labels):
+        self.table = np.asarray(table, dtype='int8')
+        self.labels = list(labels)
+
+    # Groups given by their edges, like pd.cut with right=False (`edges` has one more value than `labels`)
+    # `size` is the number of values kept in the table.
+    @classmethod
+    def from_edges(cls, edges, labels, size):
+        codes = np.searchsorted(np.asarray(edges, dtype='float64'), np.arange(size), side='right') - 1
+        codes[codes >= len(labels)] = -1
+        return cls(codes, labels)
+
+    # Groups given by a function (e.g. get_season) that is called once for each of the values 0 to size - 1
+    @classmethod
+    def from_function(cls, function, labels, size):
+        labels = list(labels)
+        return cls([labels.index(function(value)) for value in range(size)], labels)
+
+    # Labels of the values as a pandas Categorical (missing or negative values have no group)
+    def apply(self, values):
+        values = pd.Series(values).to_numpy(dtype='float64', na_value=np.nan)
+        positions = np.where(np.isnan(values), -1, values).astype('int64')
+        codes = self.table[np.clip(positions, 0, len(self.table) - 1)]
+        codes[positions < 0] = -1
+        return pd.Categorical.from_codes(codes, self.labels)
+
+# Season of each month (1 to 12)
+SEASON_BINNING = Binning.from_function(get_season, SEASONS, size=13)
+
+# Function for adding the calendar columns (YEAR, MONTH, SEASON, DAY OF WEEK, HOUR) to the trips
+# The timestamps are parsed once and the new columns are computed from their numeric fields, as small integers and categoricals instead of strings.
+def add_calendar_features(df):
+    df = df.copy(deep=False)
+    start_time = parse_divvy_time(df['START TIME'])
+    df['START TIME'] = start_time
+    if 'STOP TIME' in df.columns:
+        df['STOP TIME'] = parse_divvy_time(df['STOP TIME'])
+
+    month = start_time.dt.month.to_numpy()
+    df['YEAR'] = start_time.dt.year.astype('int16')
+    df['MONTH'] = month.astype('int8')
+    df['SEASON'] = SEASON_BINNING.apply(month)
+    df['DAY OF WEEK'] = pd.Categorical.from_codes(start_time.dt.dayofweek.to_numpy(), DAYS_OF_WEEK)
+    df['HOUR'] = start_time.dt.hour.astype('int8')
+    return df
+
+# Create new columns that we need for further analysis (Year, Season, Month, Week, etc.)
+df_MM_clean = stage_cache("calendar", add_calendar_features, df_MM_clean)
+
+# Compact trip table: once the calendar columns are added, the hot columns are stored with the smallest types that hold them.
+# Bike and station IDs fit in int16, the durations are whole seconds (int32), BIRTH YEAR is a nullable int16, the timestamps
+# are epoch seconds (datetime64[s], i.e. int64) and the calendar and demographic columns are 1-byte integers or categoricals.
+# The WKT locations and the station names are dropped (the coordinates are decoded into the station/ward table).
+# With the wards of section 2 a trip takes about 60 bytes; TRIP_BYTES_TARGET is checked after the ward join below.
+COMPACT_DTYPES = {
+    "BIKE ID": "int16",
+    "FROM STATION ID": "int16",
+    "TO STATION ID": "int16",
+    "TRIP DURATION": "int32",
+    "BIRTH YEAR": "Int16",
+    "START TIME": "datetime64[s]",
+    "STOP TIME": "datetime64[s]",
+}
+
+TRIP_BYTES_TARGET = 64
+
+def compact_trips(df):
+    df = df.drop(columns=[c for c in df.columns if c.endswith(" LOCATION") or c.endswith(" STATION NAME")])
+    for column, dtype in COMPACT_DTYPES.items():
+        if column not in df:
+            continue
+        values = df[column]
+        if values.dtype.kind == 'f':
+            values = values.round()
+        if dtype in ("int16", "int32"):
+            limits = np.iinfo(dtype)
+            if len(values) and (values.min() < limits.min or values.max() > limits.max):
+                raise ValueError(f"{column} does not fit in {dtype}")
+        df[column] = values.astype(dtype)
+    return df
+
+# Function for the resident memory of a trip table, in bytes per trip
+def bytes_per_trip(df):
+    return df.memory_usage(index=True, deep=True).sum() / max(len(df), 1)
+
+df_MM_clean = stage_cache("compact", compact_trips, df_MM_clean)
+bytes_per_trip(df_MM_clean)
+
+# ...........................................................................................
+
+# Cleaning rules: every rule is a function of the trips (a dataframe or a view of the trip store) that returns True for the
+# valid trips. The rules are evaluated once into flags (one byte per trip for up to 8 rules, a wider integer for more rules;
+# bit i is set when the trip breaks rule i), so the number of trips rejected by each rule can be reported and any combination
+# of rules is a mask instead of a chain of copies.
+# The trips that break one of the REQUIRED_RULES are removed; the other rules select the trips of the demographic analyses.
+CHICAGO_BOUNDS = (-88.0, 41.6, -87.5, 42.1)  # min longitude, min latitude, max longitude, max latitude
+
+def _within_chicago(trips):
+    min_lon, min_lat, max_lon, max_lat = CHICAGO_BOUNDS
+    return np.logical_and.reduce([trips[f"{end} {axis}"].between(low, high).to_numpy()
+                                  for end in ["FROM", "TO"]
+                                  for axis, low, high in [("LONGITUDE", min_lon, max_lon), ("LATITUDE", min_lat, max_lat)]])
+
+TRIP_RULES = {
+    "coordinates": lambda trips: np.logical_and.reduce([trips[f"{end} {axis}"].notna().to_numpy()
+                                                        for end in ["FROM", "TO"] for axis in ["LATITUDE", "LONGITUDE"]]),
+    "within chicago": _within_chicago,
+    "positive duration": lambda trips: (trips["TRIP DURATION"] > 0).to_numpy(),
+    "stop after start": lambda trips: (trips["STOP TIME"] >= trips["START TIME"]).to_numpy(),
+    "gender": lambda trips: trips["GENDER"].notna().to_numpy(),
+    "birth year": lambda trips: trips["BIRTH YEAR"].notna().to_numpy(),
+    "plausible birth year": lambda trips: (trips["BIRTH YEAR"] >= 1925).fillna(False).to_numpy(dtype=bool),
+}
+
+REQUIRED_RULES = ["coordinates", "within chicago", "positive duration", "stop after start"]
+
+# The smallest unsigned integer type with one bit per rule
+def flag_dtype(rules=TRIP_RULES):
+    for dtype in ['uint8', 'uint16', 'uint32', 'uint64']:
+        if len(rules) <= np.iinfo(dtype).bits:
+            return np.dtype(dtype)
+    raise ValueError(f"The flags hold at most 64 rules, got {len(rules)}")
+
+# Function for the flags of the trips (bit i is set when a trip breaks the i-th rule)
+def check_rules(trips, rules=TRIP_RULES):
+    flags = np.zeros(len(trips), dtype=flag_dtype(rules))
+    for bit, rule in enumerate(rules.values()):
+        flags |= (~np.asarray(rule(trips), dtype=bool)).astype(flags.dtype) << flags.dtype.type(bit)
+    return flags
+
+# Mask of the trips that follow all the rules in `names`
+def passes(flags, names, rules=TRIP_RULES):
+    bits = sum(1 << list(rules).index(name) for name in names)
+    return (np.asarray(flags) & bits) == 0
+
+# The number of trips rejected by each rule, and by that rule only
+def rule_report(flags, rules=TRIP_RULES):
+    bits = np.ones(len(rules), dtype=flags.dtype) << np.arange(len(rules), dtype=flags.dtype)
+    broken = (flags[:, None] & bits) != 0
+    only = broken & (broken.sum(axis=1) == 1)[:, None]
+    return pd.DataFrame({"REJECTED": broken.sum(axis=0), "ONLY THIS RULE": only.sum(axis=0)}, index=pd.Index(list(rules), name="RULE"))
+
+# Function for removing the trips that break the required rules (the flags are kept as a column for the other rules)
+def keep_valid_trips(df, flags, names=REQUIRED_RULES):
+    valid = passes(flags, names)
+    df = df[valid].reset_index(drop=True) if not valid.all() else df.copy(deep=False)
+    df["RULE FLAGS"] = flags[valid]
+    return df
+
+trip_flags = stage_cache("rules", check_rules, df_MM_clean, TRIP_RULES)
+rule_report(trip_flags)
+
+df_MM_clean = stage_cache("clean", keep_valid_trips, df_MM_clean, trip_flags)
+
+# ...........................................................................................
+
+# Memory-mapped trip store: every column of the compact table is saved as a .npy file (categoricals as their codes, nullable
+# integers with a separate mask) and opened with memory mapping. A filtered set of trips (a year, the trips with a known
+# gender, an age group, ...) is a view, i.e. the store with an array of row numbers, instead of a copy of the dataframe:
+# only the columns that an analysis asks for are read, and only for the rows of the view. The views are pickled as the path
+# and the row numbers, so worker processes open the same files and share their pages through the OS cache.
+import shutil
+
+TRIP_COLUMN_STORE = "trip_columns"
+
+class TripColumns:
+    def __init__(self, path=TRIP_COLUMN_STORE, rows=None):
+        self.path = path
+        self.rows = rows
+        with open(os.path.join(path, "_columns.json")) as columns_file:
+            self.columns = json.load(columns_file)
+
+    # Write the columns of `df` as a new store in `path`
+    @classmethod
+    def write(cls, df, path=TRIP_COLUMN_STORE):
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.makedirs(path)
+        with open(os.path.join(path, "_columns.json"), "w") as columns_file:
+            json.dump({}, columns_file)
+        return cls(path).add_columns(df)
+
+    # Add (or replace) columns with one value per trip of the store
+    def add_columns(self, df):
+        if self.rows is not None:
+            raise ValueError("Columns can only be added to the whole store, not to a view")
+        for column, values in df.items():
+            spec = {}
+            if isinstance(values.dtype, pd.CategoricalDtype):
+                spec["categories"] = values.cat.categories.tolist()
+                data = values.cat.codes.to_numpy()
+            elif isinstance(values.dtype, pd.api.extensions.ExtensionDtype):
+                spec["masked"] = str(values.dtype)
+                np.save(os.path.join(self.path, f"{column}.mask.npy"), values.isna().to_numpy())
+                data = values.to_numpy(dtype=values.dtype.numpy_dtype, na_value=0)
+            else:
+                data = values.to_numpy()
+            np.save(os.path.join(self.path, f"{column}.npy"), data)
+            self.columns[column] = spec
+        with open(os.path.join(self.path, "_columns.json"), "w") as columns_file:
+            json.dump(self.columns, columns_file)
+        return self
+
+    def __len__(self):
+        return len(self.rows) if self.rows is not None else len(np.load(os.path.join(self.path, f"{next(iter(self.columns))}.npy"), mmap_mode='r'))
+
+    # The raw values of a column for the rows of the view (the codes for a categorical column)
+    def array(self, column, suffix=""):
+        values = np.load(os.path.join(self.path, f"{column}{suffix}.npy"), mmap_mode='r')
+        return values if self.rows is None else values[self.rows]
+
+    # Mask of the rows where `column` has a value
+    def known(self, column):
+        spec = self.columns[column]
+        if "categories" in spec:
+            return self.array(column) >= 0
+        if "masked" in spec:
+            return ~self.array(column, ".mask")
+        values = self.array(column)
+        return ~np.isnan(values) if values.dtype.kind == 'f' else np.ones(len(values), dtype=bool)
+
+    # The view of the rows of this view where `mask` is True
+    def where(self, mask):
+        positions = np.flatnonzero(np.asarray(mask))
+        rows = positions if self.rows is None else self.rows[positions]
+        return TripColumns(self.path, rows.astype('int32') if len(rows) and rows.max() < 2**31 else rows)
+
+    def __getitem__(self, column):
+        spec = self.columns[column]
+        values = self.array(column)
+        if "categories" in spec:
+            values = pd.Categorical.from_codes(values, spec["categories"])
+        elif "masked" in spec:
+            values = pd.arrays.IntegerArray(np.asarray(values), np.asarray(self.array(column, ".mask")))
+        index = pd.RangeIndex(len(values)) if self.rows is None else pd.Index(self.rows)
+        return pd.Series(values, index=index, name=column)
+
+    # The dataframe of `columns` (all of them if None) for the rows of the view
+    def frame(self, columns=None):
+        return pd.DataFrame({column: self[column] for column in (columns or self.columns)})
+
+# The store is only written again when the cleaned trips changed
+stage_cache.store("trip columns", TRIP_COLUMN_STORE, TripColumns.write, df_MM_clean)
+trip_columns = TripColumns()
+
+# Find the minimum value in the "Start Time" column
+print("Minimum Start Time:", df_MM_clean['START TIME'].min())
+
+# Collection of data start(start-date and time) for micro-mobility dataset starts from 01:06:00 of 27th of June 2013.
+print("Most Recent Start Time:", df_MM_clean['START TIME'].max())
+
+# The most recent date and time available in dataset is 23:57:17 of 31st December 2019.
+
+# ...........................................................................................
 
-df_MM_clean["DAY OF WEEK"] = df_MM_clean_time.dt.strftime("%A")
+# - Number of records per year and month in micro-mobility dataset.
 
 # See the final result
 df_MM_clean.head()
 
+# The breakdowns below are roll-ups of a cube of trip counts and duration sums, built in one pass over the trips, instead of
+# group-bys that scan all the trips again. The cube has one row (cell) for every combination of date, gender, age group,
+# user type and rule flags that has trips; YEAR, MONTH, SEASON and DAY OF WEEK are derived from the date of the cells.
+# Only the dimensions of the breakdowns are kept, so the cells stay far fewer than the trips (section 3 has its own ward cube).
+# The age groups are defined here because the cube needs them (see the age analysis below).
+
+# Define age groups
+age_bins = [0, 18, 30, 40, 50, 60, float('inf')]  # Define age bins/ranges
+age_labels = ['0-18', '19-30', '31-40', '41-50', '51-60', '61+']  # Define corresponding labels
+
+# Age group of every age up to 120 years (older ages get the last group)
+AGE_GROUP_BINNING = Binning.from_edges(age_bins, age_labels, size=121)
+
+CUBE_DIMENSIONS = ["DATE", "GENDER", "AGE GROUP", "USER TYPE", "RULE FLAGS"]
+
+class TripCube:
+    # Columns derived from the cells when they are rolled up (more can be added, e.g. a day time from the HOUR)
+    DERIVED = {
+        "YEAR": lambda cube: (cube.column("DATE").astype('datetime64[Y]').astype('int64') + 1970).astype('int16'),
+        "MONTH": lambda cube: (cube.column("DATE").astype('datetime64[M]').astype('int64') % 12 + 1).astype('int8'),
+        "SEASON": lambda cube: SEASON_BINNING.apply(cube.column("MONTH")),
+        "DAY OF WEEK": lambda cube: pd.Categorical.from_codes((cube.column("DATE").astype('int64') + 3) % 7, DAYS_OF_WEEK),
+    }
+
+    def __init__(self, cells):
+        self.cells = cells
+
+    # Function for building the cube of `trips` (a dataframe or a view of the trip store) over the available `dimensions`
+    # (the age groups of the AGE GROUP dimension are given by `age_binning`)
+    @classmethod
+    def build(cls, trips, dimensions=CUBE_DIMENSIONS, age_binning=AGE_GROUP_BINNING):
+        start = epoch_seconds(trips["START TIME"])
+        sources = {
+            "DATE": lambda: pd.Series((start // 86400).astype('datetime64[D]').astype('datetime64[s]')),
+            "AGE GROUP": lambda: age_binning.apply(trips["YEAR"].to_numpy(dtype='float64') - trips["BIRTH YEAR"].to_numpy(dtype='float64', na_value=np.nan)),
+        }
+        keys = np.zeros(len(start), dtype='int64')
+        decoders = []
+        size = 1
+        for dimension in reversed(dimensions):
+            values = pd.Series(sources[dimension]() if dimension in sources else trips[dimension])
+            if isinstance(values.dtype, pd.CategoricalDtype):
+                # Categorical codes are shifted by one, so that the missing values are the level 0
+                codes, levels = values.cat.codes.to_numpy().astype('int64') + 1, values.cat.categories
+                decode = lambda codes, levels=levels: pd.Categorical.from_codes(codes - 1, levels)
+                n_levels = len(levels) + 1
+            else:
+                codes, levels = pd.factorize(values, sort=True, use_na_sentinel=False)
+                decode = lambda codes, levels=levels: levels.take(codes)
+                n_levels = len(levels)
+            keys += codes * size
+            decoders.append((dimension, size, n_levels, decode))
+            size *= n_levels
+
+        cells_keys, cells_index = np.unique(keys, return_inverse=True)
+        cells = {dimension: decode(cells_keys // level_size % n_levels) for dimension, level_size, n_levels, decode in reversed(decoders)}
+        cells["TRIPS"] = np.bincount(cells_index, minlength=len(cells_keys)).astype('int32')
+        cells["TRIP DURATION"] = np.bincount(cells_index, weights=trips["TRIP DURATION"].to_numpy(dtype='float64'), minlength=len(cells_keys))
+        return cls(pd.DataFrame(cells))
+
+    # A dimension or a derived column of the cells
+    def column(self, name):
+        if name in self.cells:
+            values = self.cells[name]
+            return values.to_numpy().astype('datetime64[D]') if name == "DATE" else values
+        return self.DERIVED[name](self)
+
+    # Sum of `value` ("TRIPS" or "TRIP DURATION") by `by`, over the cells of the trips that follow the cleaning `rules`
+    # and that have the values of `where` (a dict of column -> value)
+    def rollup(self, by, rules=(), where=None, value="TRIPS"):
+        mask = passes(self.cells["RULE FLAGS"], rules) if rules else np.ones(len(self.cells), dtype=bool)
+        for name, wanted in (where or {}).items():
+            mask &= np.asarray(self.column(name) == wanted)
+        keys = [pd.Series(self.column(name), name=name)[mask] for name in by]
+        values = self.cells[value][mask]
+        return values.astype('int64' if values.dtype.kind == 'i' else values.dtype).groupby(keys, observed=True).sum()
+
+    def save(self, path):
+        self.cells.to_parquet(path)
+
+    @classmethod
+    def load(cls, path):
+        return cls(pd.read_parquet(path))
+
+# The age groups are passed to the stage, so that changing age_bins/age_labels builds the cube again
+trip_cube = stage_cache("cube", TripCube.build, df_MM_clean, CUBE_DIMENSIONS, AGE_GROUP_BINNING)
+
 # Number of trips per year
-year_groups = df_MM_clean.groupby(["YEAR"]).size()
+year_groups = trip_cube.rollup(["YEAR"])
 print(year_groups)
 bp_year_groups = year_groups.plot(kind="bar")
 
 # It is shown that there is an increasing trend for years and this growth was dramatic from 2013 to 2014 and one of the reasons is that our data start from the June 2013. Also, there was a litle decrease from 2017 to 2018.
 
 # Number of trips per month
-month_groups = df_MM_clean.groupby(["MONTH"]).size()
+month_groups = trip_cube.rollup(["MONTH"])
 print(month_groups)
 bp_month_groups = month_groups.plot(kind="bar")
 
 # It shows that the majority of trips occur from June to October and it is less in cold months.
 
 # Number of trips per year and month
-month_year_groups = df_MM_clean.groupby(["YEAR", "MONTH"]).size()
+month_year_groups = trip_cube.rollup(["YEAR", "MONTH"])
 print(month_year_groups)
 
 # Bar plot to show the year-month pattern of data
@@ -143,50 +913,180 @@ bp_month_year_groups = month_year_groups.plot(kind="bar", figsize=(30, 20))
 # - Are there any trends based on the gender and age of the user ?
 df_MM_clean.info()
 
+# Instead of grouping by (period, BIKE ID), which only lists the bikes of every period, the number of distinct bikes of each
+# period is counted on sorted integer keys, and the number of bikes in use at the same time comes from a sweep over the trips.
+
+# Function for turning the slicing columns `by` into one integer code per trip
+# It returns the codes, the mask of the trips that have a value for every column, the values (levels) of each column and the number of slices.
+# For categorical columns all the categories are kept as levels, so that the number of slices does not depend on the data.
+def slice_codes(df, by=()):
+    slice_index = np.zeros(len(df), dtype='int64')
+    valid = np.ones(len(df), dtype=bool)
+    n_slices = 1
+
+    levels = {}
+    for column in reversed(list(by)):
+        if isinstance(df[column].dtype, pd.CategoricalDtype):
+            codes, uniques = df[column].cat.codes.to_numpy(), df[column].cat.categories
+        else:
+            codes, uniques = pd.factorize(df[column], sort=True)
+        levels[column] = list(uniques)
+        valid &= codes >= 0
+        slice_index += codes.astype('int64') * n_slices
+        n_slices *= len(uniques)
+
+    return slice_index, valid, {column: levels[column] for column in by}, n_slices
+
+# Function for the number of distinct bikes used in each slice of `by` (e.g. ["YEAR"] or ["YEAR", "MONTH"])
+# Each (slice, bike) pair becomes one integer key; the distinct keys are found by sorting them and counted per slice.
+def distinct_bikes(df, by):
+    slice_index, valid, levels, n_slices = slice_codes(df, by)
+    bike_codes, bike_ids = pd.factorize(df["BIKE ID"])
+    pairs = np.unique(slice_index[valid] * len(bike_ids) + bike_codes[valid])
+    counts = np.bincount(pairs // len(bike_ids), minlength=n_slices)
+    if len(by) == 1:
+        return pd.Series(counts, index=pd.Index(levels[by[0]], name=by[0]), name="BIKES")
+    return pd.Series(counts, index=pd.MultiIndex.from_product(list(levels.values()), names=by), name="BIKES")
+
+# When the trips are no longer in memory (e.g. the months of the aggregate store), the number of distinct bikes is estimated
+# with HyperLogLog sketches of the BIKE IDs of every day: a sketch is an array of 2**HLL_PRECISION one-byte registers, the
+# sketch of several days is the element-wise maximum of their sketches, and the number of distinct bikes is estimated from
+# the registers with a relative standard error of 1.04 / sqrt(2**HLL_PRECISION) (0.8%). So the distinct bikes of any period
+# (year, month, season, weekday, ...) of the stored months come from their daily sketches alone, with a memory that depends
+# on the number of days and not on the number of trips. The trips in memory use the exact counts of distinct_bikes.
+HLL_PRECISION = 14
+
+# 64-bit hash of integer values (splitmix64 finalizer)
+def hash64(values):
+    x = np.asarray(values).astype('uint64') + np.uint64(0x9E3779B97F4A7C15)
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+# Estimated number of distinct values of each sketch (the last axis of `registers`), with the small-range correction
+def hll_estimate(registers):
+    m = registers.shape[-1]
+    raw = 0.7213 / (1 + 1.079 / m) * m * m / np.exp2(-registers.astype('float64')).sum(axis=-1)
+    zeros = np.count_nonzero(registers == 0, axis=-1)
+    return np.where((raw <= 2.5 * m) & (zeros > 0), m * np.log(m / np.maximum(zeros, 1)), raw)
+
+class BikeSketches:
+    def __init__(self, days, registers):
+        self.days = days
+        self.registers = registers
+
+    # Function for the daily sketches of the bikes of `trips` ("START TIME" and "BIKE ID")
+    @classmethod
+    def from_trips(cls, trips, precision=HLL_PRECISION):
+        hashes = hash64(trips["BIKE ID"].to_numpy())
+        buckets = (hashes >> np.uint64(64 - precision)).astype('int64')
+        # Rank = number of leading zeros of the other 64 - precision bits, plus one (frexp gives the position of the highest set bit)
+        rest = (hashes & np.uint64((1 << (64 - precision)) - 1)).astype('float64')
+        ranks = (64 - precision + 1 - np.frexp(rest)[1]).astype('uint8')
+
+        days, day_index = np.unique(epoch_seconds(trips["START TIME"]) // 86400, return_inverse=True)
+        registers = np.zeros((len(days), 1 << precision), dtype='uint8')
+        np.maximum.at(registers, (day_index, buckets), ranks)
+        return cls(days.astype('datetime64[D]'), registers)
+
+    # Union of the sketches of two sets of days
+    def __add__(self, other):
+        days, day_index = np.unique(np.concatenate([self.days, other.days]), return_inverse=True)
+        registers = np.zeros((len(days), self.registers.shape[1]), dtype='uint8')
+        np.maximum.at(registers, day_index, np.concatenate([self.registers, other.registers]))
+        return BikeSketches(days, registers)
+
+    # The days or a column derived from them (YEAR, MONTH, SEASON, DAY OF WEEK, as in the trip cube)
+    def column(self, name):
+        return self.days if name == "DATE" else TripCube.DERIVED[name](self)
+
+    # Estimated number of distinct bikes in each period of `by` (e.g. ["YEAR"] or ["YEAR", "MONTH"])
+    def distinct(self, by):
+        periods = pd.DataFrame({name: self.column(name) for name in by}).groupby(by, observed=True)
+        union = np.zeros((periods.ngroups, self.registers.shape[1]), dtype='uint8')
+        np.maximum.at(union, periods.ngroup().to_numpy(), self.registers)
+        return pd.Series(hll_estimate(union).round().astype('int64'), index=periods.size().index, name="BIKES")
+
+    def save(self, path):
+        np.savez_compressed(path, days=self.days.astype('int64'), registers=self.registers)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as saved:
+            return cls(saved["days"].astype('datetime64[D]'), saved["registers"])
+
+# Number of seconds in each time resolution
+RESOLUTIONS = {'minute': 60, 'hour': 3600, 'day': 86400}
+
+# Function for the number of bikes in use in each minute, hour or day (sweep line over the trip intervals)
+# Every trip adds +1 in the period of its start and -1 after the period of its stop, so the cumulative sum of these events
+# is the number of trips in progress (a trip counts in every period that it overlaps).
+def bikes_in_use(df, resolution='hour'):
+    step = RESOLUTIONS[resolution]
+    start = epoch_seconds(df["START TIME"]) // step
+    stop = np.maximum(epoch_seconds(df["STOP TIME"]) // step, start)
+
+    first_period = start.min()
+    n_periods = stop.max() - first_period + 1
+    events = np.bincount(start - first_period, minlength=n_periods + 1) - np.bincount(stop - first_period + 1, minlength=n_periods + 1)
+
+    periods = ((first_period + np.arange(n_periods)) * step).astype('datetime64[s]')
+    return pd.Series(np.cumsum(events)[:n_periods], index=pd.DatetimeIndex(periods, name=resolution.upper()), name="BIKES IN USE")
+
 # Comparing used bicycles in different years
-vehicle_groups = df_MM_clean.groupby(["YEAR", "BIKE ID"]).size()
+vehicle_groups = distinct_bikes(df_MM_clean, ["YEAR"])
 print(vehicle_groups)
+bp_vehicle_groups = vehicle_groups.plot(kind="bar")
+
+# Maximum number of bikes in use at the same time in each year (hourly and per minute)
+bikes_in_use_hourly = bikes_in_use(df_MM_clean, 'hour')
+print(bikes_in_use_hourly.groupby(bikes_in_use_hourly.index.year).max())
+bikes_in_use_minute = bikes_in_use(df_MM_clean, 'minute')
+print(bikes_in_use_minute.groupby(bikes_in_use_minute.index.year).max())
 
 # Analyzing seasonal trends
-season_groups = df_MM_clean.groupby(["SEASON"]).size()
+season_groups = trip_cube.rollup(["SEASON"])
 print(season_groups)
 bp_season_groups = season_groups.plot(kind="bar")
 
 # It shows that most of the trips happened on Summer and after that on Autumn
 
-vehicle_season_groups = df_MM_clean.groupby(["SEASON", "BIKE ID"]).size()
+vehicle_season_groups = distinct_bikes(df_MM_clean, ["SEASON"])
 print(vehicle_season_groups)
 
-vehicle_month_groups = df_MM_clean.groupby(["YEAR", "MONTH", "BIKE ID"]).size()
+vehicle_month_groups = distinct_bikes(df_MM_clean, ["YEAR", "MONTH"])
 print(vehicle_month_groups)
 
 # Analyzing weekly trends
-week_groups = df_MM_clean.groupby(["DAY OF WEEK"]).size()
+week_groups = trip_cube.rollup(["DAY OF WEEK"])
 print(week_groups)
 bp_week_groups = week_groups.plot(kind="bar")
 
 # It shows that most of the trips happened on weekdays but the difference is not very significant
 
-vehicle_week_groups = df_MM_clean.groupby(["DAY OF WEEK", "BIKE ID"]).size()
+vehicle_week_groups = distinct_bikes(df_MM_clean, ["DAY OF WEEK"])
 print(vehicle_week_groups)
 
 # ...........................................................................................
 
 # Now I am going to clean the data again based on GENDER and BIRTH YEAR
-df_MM_clean_GB = df_MM_clean.dropna(axis=0)
+# The trips with a known gender and birth year (from the rule flags) are a view of the trip store, and only the columns used below are read for them
+trip_rule_flags = trip_columns.array("RULE FLAGS")
+trips_GB = trip_columns.where(passes(trip_rule_flags, ["gender", "birth year"]))
+df_MM_clean_GB = trips_GB.frame(["GENDER", "BIRTH YEAR"])
 df_MM_clean_GB.count()
 
 # Now there are 16,346,709 rows for all the columns.
 
-df_MM_clean_GB['GENDER'].value_counts()
-gender_year_groups = df_MM_clean_GB.groupby(["YEAR", "GENDER"]).size()
+trip_cube.rollup(["GENDER"], rules=["gender", "birth year"])
+gender_year_groups = trip_cube.rollup(["YEAR", "GENDER"], rules=["gender", "birth year"])
 print(gender_year_groups)
 bp_gender_year_groups = gender_year_groups.plot(kind="bar")
 
 # It is shown that in general through these years the number of trips increased but the share of males have been always way more than females
 
 # Evaluating the gender trends within months
-gender_month_groups = df_MM_clean_GB.groupby(["MONTH", "GENDER"]).size()
+gender_month_groups = trip_cube.rollup(["MONTH", "GENDER"], rules=["gender", "birth year"])
 print(gender_month_groups)
 bp_gender_month_groups = gender_month_groups.plot(kind="bar")
 
@@ -204,35 +1104,22 @@ df_MM_clean_GB['BIRTH YEAR'].value_counts()
 # It is shown that there are some data which are obviously incorrect such as 1790. So, I am getting rid of these data. 
 
 # Drop incorrect rows
-df_MM_clean_B = df_MM_clean_GB[df_MM_clean_GB['BIRTH YEAR'] >= 1925]
+trips_B = trip_columns.where(passes(trip_rule_flags, ["gender", "birth year", "plausible birth year"]))
+df_MM_clean_B = trips_B.frame(["BIRTH YEAR"])
 df_MM_clean_B.count()
 df_MM_clean_B['BIRTH YEAR'].min()
 
 # Now we can say that the minimum of BIRTH YEAR is 1925 and the maximum of it is 2017.
 
-df_MM_clean_B = df_MM_clean_B.dropna(subset=['BIRTH YEAR'])
-
-# Convert BIRTH YEAR and YEAR to integer
-df_MM_clean_B['BIRTH YEAR'] = df_MM_clean_B['BIRTH YEAR'].astype('int')
-df_MM_clean_B['YEAR'] = df_MM_clean_B['YEAR'].astype('int')
-
-# Create age groups based on the age distribution of users
-df_MM_clean_B['age'] = df_MM_clean_B['YEAR'] - df_MM_clean_B['BIRTH YEAR']
-
-# Define age groups
-age_bins = [0, 18, 30, 40, 50, 60, float('inf')]  # Define age bins/ranges
-age_labels = ['0-18', '19-30', '31-40', '41-50', '51-60', '61+']  # Define corresponding labels
-
-# Create 'age group' column using pd.cut
-df_MM_clean_B['age group'] = pd.cut(df_MM_clean_B['age'], bins=age_bins, labels=age_labels, right=False)
-age_groups = df_MM_clean_B.groupby("age group").size()
+# The age groups (age_bins, age_labels) of the cube are based on the age distribution of users: age = YEAR - BIRTH YEAR
+age_groups = trip_cube.rollup(["AGE GROUP"], rules=["gender", "birth year", "plausible birth year"])
 print(age_groups)
 bp_age_groups = age_groups.plot(kind="bar")
 
 # It can be seen that the majority of users belong to the age group between 19-40 years old.
 
 # Evaluating the age trend within years
-age_year_groups = df_MM_clean_B.groupby(["YEAR", "age group"]).size()
+age_year_groups = trip_cube.rollup(["YEAR", "AGE GROUP"], rules=["gender", "birth year", "plausible birth year"])
 print(age_year_groups)
 bp_age_year_groups = age_year_groups.plot(kind="bar", figsize=(30, 20))
 
@@ -249,454 +1136,662 @@ bp_age_year_groups = age_year_groups.plot(kind="bar", figsize=(30, 20))
 # - Based on observation, visualise selected OD matrices that show some trends/periodicity on a map. 
 # - Create a flowmap for the OD matrices.
 
-# First I installed geopandas in order to do spatial analysis and determine each trip point (from/to) is within which ward of Chicago based on latitude and longitude
-pip install geopandas
-pip install rtree
-pip install pygeos
-
-# In this part, because the size of the file is too much large and I encountered memory issues for spatial joining, I decided to select only 3 years to work on.
-df_MM_clean_2016 = df_MM_clean[df_MM_clean['YEAR'] == '2016']
-
-import geopandas as gpd
-from shapely import wkt
-
-# Convert 'the_geom' in wards_chicago from WKT(Well Known text) to shapely objects
-# 'the_geom' column contains MULTIPOLYGON data in text format
-df_boundaries['the_geom'] = df_boundaries['the_geom'].apply(wkt.loads)
-wards_gdf = gpd.GeoDataFrame(df_boundaries, geometry='the_geom')
-
-# Convert 'FROM LOCATION' and 'TO LOCATION' in df_chicago from WKT to shapely Point objects
-# These columns contain POINT data in text format
-df_MM_clean_2016['from_point'] = df_MM_clean_2016['FROM LOCATION'].apply(wkt.loads)
-df_from_gdf_2016 = gpd.GeoDataFrame(df_MM_clean_2016, geometry='from_point')
-
-df_MM_clean_2016['to_point'] = df_MM_clean_2016['TO LOCATION'].apply(wkt.loads)
-df_to_gdf_2016 = gpd.GeoDataFrame(df_MM_clean_2016, geometry='to_point')
-
-# Ensure the CRS for both GeoDataFrames are the same
-# This can be done by setting the CRS(Co-ordinate Reference System) of df_from_gdf and df_to_gdf to match that of wards_gdf
-df_from_gdf_2016 = df_from_gdf_2016.set_crs('EPSG:4326', inplace=True,allow_override = True)
-df_to_gdf_2016 = df_to_gdf_2016.set_crs('EPSG:4326', inplace=True,allow_override = True)
-wards_gdf = wards_gdf.set_crs('EPSG:4326', inplace=True,allow_override = True)
-
-# Perform spatial joins
-# Join df_from_gdf and df_to_gdf with wards_gdf to find the corresponding wards
-from_joined_2016 = gpd.sjoin(df_from_gdf_2016, wards_gdf, how="left", op='within')
-to_joined_2016 = gpd.sjoin(df_to_gdf_2016, wards_gdf, how="left", op='within')
-
-# Add the ward information back to the original df_chicago DataFrame
-df_MM_clean_2016['FROM WARD'] = from_joined_2016['Ward']  # Replace 'Ward' with the actual column name in wards_gdf
-df_MM_clean_2016['TO WARD'] = to_joined_2016['Ward']      # Replace 'Ward' with the actual column name in wards_gdf
-df_MM_clean_2016.to_csv("df_MM_clean_2016", index=False)
-
-# Display the first few rows of the updated df_chicago to check the results
-df_MM_clean_2016.head()
-
-
-df_MM_clean_2017 = df_MM_clean[df_MM_clean['YEAR'] == '2017']
-
-# Convert 'FROM LOCATION' and 'TO LOCATION' in df_chicago from WKT to shapely Point objects
-# These columns contain POINT data in text format
-df_MM_clean_2017['from_point'] = df_MM_clean_2017['FROM LOCATION'].apply(wkt.loads)
-df_from_gdf_2017 = gpd.GeoDataFrame(df_MM_clean_2017, geometry='from_point')
-df_MM_clean_2017['to_point'] = df_MM_clean_2017['TO LOCATION'].apply(wkt.loads)
-df_to_gdf_2017 = gpd.GeoDataFrame(df_MM_clean_2017, geometry='to_point')
-
-# Ensure the CRS for both GeoDataFrames are the same
-# This can be done by setting the CRS(Co-ordinate Reference System) of df_from_gdf and df_to_gdf to match that of wards_gdf
-df_from_gdf_2017 = df_from_gdf_2017.set_crs('EPSG:4326', inplace=True,allow_override = True)
-df_to_gdf_2017 = df_to_gdf_2017.set_crs('EPSG:4326', inplace=True,allow_override = True)
-wards_gdf = wards_gdf.set_crs('EPSG:4326', inplace=True,allow_override = True)
-
-# Perform spatial joins
-# Join df_from_gdf and df_to_gdf with wards_gdf to find the corresponding wards
-from_joined_2017 = gpd.sjoin(df_from_gdf_2017, wards_gdf, how="left", op='within')
-to_joined_2017 = gpd.sjoin(df_to_gdf_2017, wards_gdf, how="left", op='within')
-
-# Add the ward information back to the original df_chicago DataFrame
-df_MM_clean_2017['FROM WARD'] = from_joined_2017['Ward']  # Replace 'Ward' with the actual column name in wards_gdf
-df_MM_clean_2017['TO WARD'] = to_joined_2017['Ward']      # Replace 'Ward' with the actual column name in wards_gdf
-df_MM_clean_2017.to_csv("df_MM_clean_2017", index=False)
-
-# Display the first few rows of the updated df_chicago to check the results
-df_MM_clean_2017.head()
-
-df_MM_clean_2018 = df_MM_clean[df_MM_clean['YEAR'] == '2018']
-
-# Convert 'FROM LOCATION' and 'TO LOCATION' in df_chicago from WKT to shapely Point objects
-# These columns contain POINT data in text format
-df_MM_clean_2018['from_point'] = df_MM_clean_2018['FROM LOCATION'].apply(wkt.loads)
-df_from_gdf_2018 = gpd.GeoDataFrame(df_MM_clean_2018, geometry='from_point')
-df_MM_clean_2018['to_point'] = df_MM_clean_2018['TO LOCATION'].apply(wkt.loads)
-df_to_gdf_2018 = gpd.GeoDataFrame(df_MM_clean_2018, geometry='to_point')
-
-# Ensure the CRS for both GeoDataFrames are the same
-# This can be done by setting the CRS(Co-ordinate Reference System) of df_from_gdf and df_to_gdf to match that of wards_gdf
-df_from_gdf_2018 = df_from_gdf_2018.set_crs('EPSG:4326', inplace=True,allow_override = True)
-df_to_gdf_2018 = df_to_gdf_2018.set_crs('EPSG:4326', inplace=True,allow_override = True)
-wards_gdf = wards_gdf.set_crs('EPSG:4326', inplace=True,allow_override = True)
-
-# Perform spatial joins
-# Join df_from_gdf and df_to_gdf with wards_gdf to find the corresponding wards
-from_joined_2018 = gpd.sjoin(df_from_gdf_2018, wards_gdf, how="left", op='within')
-to_joined_2018 = gpd.sjoin(df_to_gdf_2018, wards_gdf, how="left", op='within')
-
-# Add the ward information back to the original df_chicago DataFrame
-df_MM_clean_2018['FROM WARD'] = from_joined_2018['Ward']  # Replace 'Ward' with the actual column name in wards_gdf
-df_MM_clean_2018['TO WARD'] = to_joined_2018['Ward']      # Replace 'Ward' with the actual column name in wards_gdf
-df_MM_clean_2018.to_csv("df_MM_clean_2018", index=False)
-
-# Display the first few rows of the updated df_chicago to check the results
-df_MM_clean_2018.head()
-
-# ...........................................................................................
-
-# - Compute then the O-D matrix, i.e., the number of bookings starting in ward i and ending in ward j.
-
-# OD Matrix 2016 calculation using pivot table
-matrix_2016 = (
-    df_MM_clean_2016.assign(count=1)
-    .pivot_table(index='FROM WARD', columns='TO WARD',
-                 values="count", aggfunc="count")
-    .fillna(0)
-    .astype(int)
-).sort_values('FROM WARD')
-
-matrix_2016
-
-
-# OD Matrix 2017 calculation using pivot table
-matrix_2017 = (
-    df_MM_clean_2017.assign(count=1)
-    .pivot_table(index='FROM WARD', columns='TO WARD',
-                 values="count", aggfunc="count")
-    .fillna(0)
-    .astype(int)
-).sort_values('FROM WARD')
-
-matrix_2017
-
+# First I installed shapely in order to do spatial analysis and determine each trip point (from/to) is within which ward of Chicago based on latitude and longitude
+pip install shapely
+pip install pyarrow
+pip install scipy
+
+# Instead of saving every intermediate dataframe as a csv file and parsing it again in the next sections, I am keeping the cleaned trips
+# in a Parquet dataset partitioned by YEAR and MONTH. Each section can then read only the years/months and the columns that it needs.
+import os
+import shutil
+
+TRIP_CACHE = "df_MM_clean_parquet"
+
+# Function for writing trips into the Parquet cache
+# Only the YEAR/MONTH partitions present in `df` are replaced, the other partitions stay untouched.
+# With append=True the trips are added to the partitions instead (e.g. when the trips of a month arrive in several chunks).
+def write_trip_cache(df, path=TRIP_CACHE, append=False):
+    df.to_parquet(path, engine='pyarrow', index=False, partition_cols=["YEAR", "MONTH"],
+                  existing_data_behavior='overwrite_or_ignore' if append else 'delete_matching')
+
+# Function for listing the (year, month) partitions of the cache
+def trip_cache_months(path=TRIP_CACHE):
+    months = []
+    for year_folder in os.listdir(path):
+        for month_folder in os.listdir(os.path.join(path, year_folder)):
+            months.append((int(year_folder.split("=")[1]), int(month_folder.split("=")[1])))
+    return sorted(months)
+
+# Function for reading the Parquet cache with partition pruning (years, months) and column projection (columns)
+def read_trip_cache(path=TRIP_CACHE, years=None, months=None, columns=None):
+    filters = []
+    if years is not None:
+        filters.append(("YEAR", "in", [int(year) for year in years]))
+    if months is not None:
+        filters.append(("MONTH", "in", [int(month) for month in months]))
+
+    df = pd.read_parquet(path, engine='pyarrow', columns=columns, filters=filters or None)
+
+    # Partition keys come back as categoricals, but the analysis uses them as numbers
+    for column in ["YEAR", "MONTH"]:
+        if column in df.columns:
+            df[column] = df[column].astype('int')
+    return df
+
+import shapely
+
+# Previously, I converted 'FROM LOCATION' and 'TO LOCATION' of every trip from WKT to a shapely Point object and ran two geopandas
+# spatial joins per year. Because of the memory needed by these Point objects I could only work on 3 years.
+# Now the wards are assigned directly from the LATITUDE/LONGITUDE columns (float arrays) in vectorized batches, against an
+# index of the ward polygons that is built only once and shared by the origins and the destinations of all the trips.
+
+# Function for building the index of the ward polygons
+# 'the_geom' column contains MULTIPOLYGON data in WKT(Well Known text) format. For each ward the prepared polygon and its
+# bounding box are kept, so that a point is only tested against the wards whose bounding box contains it.
+def build_ward_index(df_boundaries, ward_column='Ward', geometry_column='the_geom'):
+    geometries = shapely.from_wkt(df_boundaries[geometry_column].to_numpy())
+    shapely.prepare(geometries)
+    return {
+        "ward": df_boundaries[ward_column].to_numpy().astype('int16'),
+        "geometry": geometries,
+        "bounds": shapely.bounds(geometries),
+    }
+
+# Function for finding the ward of each point (longitude, latitude arrays) in batches of `batch_size` points
+# The points that are not within any ward get -1.
+def assign_wards(ward_index, longitude, latitude, batch_size=2_000_000):
+    wards = np.full(len(longitude), -1, dtype='int16')
+
+    for start in range(0, len(longitude), batch_size):
+        x = np.asarray(longitude[start:start + batch_size], dtype='float64')
+        y = np.asarray(latitude[start:start + batch_size], dtype='float64')
+        batch_wards = wards[start:start + batch_size]
+
+        for ward, geometry, (min_x, min_y, max_x, max_y) in zip(ward_index["ward"], ward_index["geometry"], ward_index["bounds"]):
+            candidates = np.flatnonzero((batch_wards < 0) & (x >= min_x) & (x <= max_x) & (y >= min_y) & (y <= max_y))
+            if len(candidates) > 0:
+                inside = shapely.contains_xy(geometry, x[candidates], y[candidates])
+                batch_wards[candidates[inside]] = ward
+    return wards
+
+# Divvy trips always start and end at one of a few hundred stations, so instead of joining millions of trip ends with the
+# wards, each station is joined only once and the trips get the ward of their stations with an array lookup.
+STATION_WARDS = "station_wards.parquet"
+STATION_COLUMNS = ["STATION ID", "LATITUDE", "LONGITUDE"]
+
+# Function for reading the saved station -> ward table (None before the first run)
+def read_station_wards(path=STATION_WARDS):
+    if not os.path.exists(path):
+        return None
+    return pd.read_parquet(path)
+
+# Function for updating the station -> ward table with the stations of the trips
+# Each distinct (station id, latitude, longitude) is joined with the wards only once: the stations that are already in
+# `station_wards` are kept as they are and only the new (or moved) stations are joined.
+def update_station_wards(df, ward_index, station_wards=None):
+    stations = pd.concat([
+        df[[f"{end} STATION ID", f"{end} LATITUDE", f"{end} LONGITUDE"]].drop_duplicates().set_axis(STATION_COLUMNS, axis=1)
+        for end in ["FROM", "TO"]
+    ]).drop_duplicates()
+
+    if station_wards is not None:
+        known = stations.merge(station_wards[STATION_COLUMNS], on=STATION_COLUMNS, how='left', indicator=True)['_merge'] == 'both'
+        stations = stations[~known.to_numpy()]
+    stations = stations.assign(WARD=assign_wards(ward_index, stations["LONGITUDE"].to_numpy(), stations["LATITUDE"].to_numpy()))
+
+    return pd.concat([station_wards, stations], ignore_index=True).sort_values(STATION_COLUMNS, ignore_index=True)
+
+# Function for adding "FROM WARD" and "TO WARD" columns to the trips from the station -> ward table (missing when the station is outside of the wards)
+def add_trip_wards(df, station_wards):
+    df = df.copy(deep=False)
+    # Array indexed by station id; -2 marks the stations that moved between wards, they are looked up by their location
+    ward_range = station_wards.groupby("STATION ID")["WARD"].agg(["min", "max"])
+    lookup = np.full(ward_range.index.max() + 1, -1, dtype='int16')
+    lookup[ward_range.index] = np.where(ward_range["min"] == ward_range["max"], ward_range["min"], -2)
+    station_keys = pd.MultiIndex.from_frame(station_wards[STATION_COLUMNS])
+
+    for end in ["FROM", "TO"]:
+        station_ids = df[f"{end} STATION ID"].to_numpy()
+        wards = np.full(len(station_ids), -1, dtype='int16')
+        known = station_ids < len(lookup)
+        wards[known] = lookup[station_ids[known]]
+
+        moved = np.flatnonzero(wards == -2)
+        if len(moved) > 0:
+            rows = station_keys.get_indexer(pd.MultiIndex.from_arrays([
+                station_ids[moved], df[f"{end} LATITUDE"].to_numpy()[moved], df[f"{end} LONGITUDE"].to_numpy()[moved]]))
+            wards[moved] = np.where(rows >= 0, station_wards["WARD"].to_numpy()[rows], -1)
+
+        df[f"{end} WARD"] = pd.Series(wards, index=df.index, dtype='Int16').mask(wards < 0)
+    return df
+
+ward_index = build_ward_index(df_boundaries)
+
+# Only the stations that are not in the saved table yet are joined with the wards
+station_wards = update_station_wards(df_MM_clean, ward_index, read_station_wards())
+station_wards.to_parquet(STATION_WARDS, index=False)
+
+# All the trips get their wards in one pass
+df_MM_clean = stage_cache("wards", add_trip_wards, df_MM_clean, station_wards)
+
+# Display the first few rows of the updated dataframe to check the results
+df_MM_clean.head()
 
-# OD Matrix 2018 calculation using pivot table
-matrix_2018 = (
-    df_MM_clean_2018.assign(count=1)
-    .pivot_table(index='FROM WARD', columns='TO WARD',
-                 values="count", aggfunc="count")
-    .fillna(0)
-    .astype(int)
-).sort_values('FROM WARD')
+# The compact trip table with its wards has to stay within the memory target of section 1
+assert bytes_per_trip(df_MM_clean) <= TRIP_BYTES_TARGET, f"{bytes_per_trip(df_MM_clean):.1f} bytes per trip"
 
-matrix_2018
+# The wards are added to the memory-mapped trip store of section 1
+stage_cache.store("trip wards", TRIP_COLUMN_STORE, trip_columns.add_columns, df_MM_clean[["FROM WARD", "TO WARD"]])
+trip_columns = TripColumns()
 
+# The cubes are saved with the results: the cube of section 1, and a ward cube with only the dimensions of the
+# day-time analysis of section 3 (the trips per from ward, year and hour)
+TRIP_CUBE = "trip_cube.parquet"
+WARD_CUBE = "ward_cube.parquet"
+WARD_CUBE_DIMENSIONS = ["YEAR", "HOUR", "FROM WARD"]
+trip_cube.save(TRIP_CUBE)
+ward_cube = stage_cache("ward cube", TripCube.build, df_MM_clean, WARD_CUBE_DIMENSIONS)
+ward_cube.save(WARD_CUBE)
 
-# Saving OD Matrices
-matrix_2016.to_csv("matrix_2016", index=False)
-matrix_2017.to_csv("matrix_2017", index=False)
-matrix_2018.to_csv("matrix_2018", index=False)
+# One-time conversion of the cleaned trips with their wards into the cache (skipped when these trips are already in it)
+stage_cache.store("trip cache", TRIP_CACHE, write_trip_cache, df_MM_clean)
 
 # ...........................................................................................
 
-# - Prepare OD matrices for different years and different age groups(3 OD matrices for each age-group of 3 consecutive years). Are there any periodicity or trends noticed? Is there a difference between the OD matrices for different age groups?
-
-import pandas as pd
-
-# Using saved dataframes with "from wards" and "to wards" to avoid kernel disconnecting.
-df_MM_clean_2016 = pd.read_csv("df_MM_clean_2016", on_bad_lines = 'warn', sep=',')
-df_MM_clean_2017 = pd.read_csv("df_MM_clean_2017", on_bad_lines = 'warn', sep=',')
-df_MM_clean_2018 = pd.read_csv("df_MM_clean_2018", on_bad_lines = 'warn', sep=',')
-
-# Drop null values
-df_MM_clean_2016 = df_MM_clean_2016.dropna(subset=['BIRTH YEAR'])
-
-# Convert BIRTH YEAR to integer
-df_MM_clean_2016['BIRTH YEAR'] = df_MM_clean_2016['BIRTH YEAR'].astype('int')
-
-# Create age groups based on the agr distribution of users
-df_MM_clean_2016['age'] = df_MM_clean_2016['YEAR'] - df_MM_clean_2016['BIRTH YEAR']
-
-# Define age groups
-age_bins = [0, 18, 30, 40, 50, 60, float('inf')]  # Define age bins/ranges
-age_labels = ['0-18', '19-30', '31-40', '41-50', '51-60', '61+']  # Define corresponding labels
-
-# Create 'age group' column using pd.cut
-df_MM_clean_2016['age group'] = pd.cut(df_MM_clean_2016['age'], bins=age_bins, labels=age_labels, right=False)
-
-
-age_group_under_18_2016 = df_MM_clean_2016[df_MM_clean_2016['age group'] == '0-18']
-# OD Matrix
-matrix_age_under_18_2016 = (
-    age_group_under_18_2016.assign(count=1)
-    .pivot_table(index='FROM WARD', columns='TO WARD',
-                 values="count", aggfunc="count")
-    .fillna(0)
-    .astype(int)
-).sort_values('FROM WARD')
-
-matrix_age_under_18_2016
-
-
-# It shows the OD matrix of under-18 age group users in 2016
-
-
-age_group_19_30_2016 = df_MM_clean_2016[df_MM_clean_2016['age group'] == '19-30']
-# OD Matrix
-matrix_age_19_30_2016 = (
-    age_group_19_30_2016.assign(count=1)
-    .pivot_table(index='FROM WARD', columns='TO WARD',
-                 values="count", aggfunc="count")
-    .fillna(0)
-    .astype(int)
-).sort_values('FROM WARD')
-
-matrix_age_19_30_2016
-
-
-age_group_31_40_2016 = df_MM_clean_2016[df_MM_clean_2016['age group'] == '31-40']
-# OD Matrix
-matrix_age_31_40_2016 = (
-    age_group_31_40_2016.assign(count=1)
-    .pivot_table(index='FROM WARD', columns='TO WARD',
-                 values="count", aggfunc="count")
-    .fillna(0)
-    .astype(int)
-).sort_values('FROM WARD')
-
-matrix_age_31_40_2016
-
-
-age_group_41_50_2016 = df_MM_clean_2016[df_MM_clean_2016['age group'] == '41-50']
-# OD Matrix
-matrix_age_41_50_2016 = (
-    age_group_41_50_2016.assign(count=1)
-    .pivot_table(index='FROM WARD', columns='TO WARD',
-                 values="count", aggfunc="count")
-    .fillna(0)
-    .astype(int)
-).sort_values('FROM WARD')
-
-matrix_age_41_50_2016
-
+# - Compute then the O-D matrix, i.e., the number of bookings starting in ward i and ending in ward j.
 
-age_group_51_60_2016 = df_MM_clean_2016[df_MM_clean_2016['age group'] == '51-60']
-# OD Matrix
-matrix_age_51_60_2016 = (
-    age_group_51_60_2016.assign(count=1)
-    .pivot_table(index='FROM WARD', columns='TO WARD',
-                 values="count", aggfunc="count")
-    .fillna(0)
-    .astype(int)
-).sort_values('FROM WARD')
+# Instead of filtering the trips and building one pivot table per year and per age group, all the OD matrices are computed
+# in one scan of the trips: the wards and the slicing columns (YEAR, age group, SEASON, DAY_TIME, GENDER, ...) are turned
+# into integer codes, combined into one index per trip and counted with a single bincount.
+
+# Chicago wards
+WARDS = np.arange(1, 51)
+
+# Function for turning zone labels (wards, stations) into positions in `zones` (-1 when missing or unknown)
+def zone_codes(values, zones):
+    return pd.Index(zones).get_indexer(pd.Series(values).to_numpy(dtype='float64', na_value=np.nan))
+
+# Function for computing the OD counts of every slice of `by` (list of columns) in one scan
+# It returns an array of shape (number of values of by[0], ..., number of wards, number of wards) and the values (levels) of each slicing column.
+def od_counts(df, by=(), wards=WARDS):
+    n_wards = len(wards)
+    from_codes = zone_codes(df['FROM WARD'], wards)
+    to_codes = zone_codes(df['TO WARD'], wards)
+    slice_index, valid, levels, n_slices = slice_codes(df, by)
+
+    valid &= (from_codes >= 0) & (to_codes >= 0)
+    flat_index = (slice_index * n_wards + from_codes) * n_wards + to_codes
+
+    shape = [len(values) for values in levels.values()] + [n_wards, n_wards]
+    counts = np.bincount(flat_index[valid], minlength=n_slices * n_wards * n_wards).reshape(shape)
+    return counts, levels
+
+# Function for turning the OD counts of every slice into OD matrices (dataframes like the pivot tables, FROM WARD x TO WARD)
+# The keys are the slice values (a tuple when there are several slicing columns). Like a pivot table, only the wards with at least one trip are kept.
+def od_matrices(counts, levels, wards=WARDS, drop_empty=True):
+    matrices = {}
+    for position in np.ndindex(*counts.shape[:-2]):
+        key = tuple(values[i] for values, i in zip(levels.values(), position))
+        values = counts[position]
+        matrix = pd.DataFrame(values, index=pd.Index(wards, name='FROM WARD'), columns=pd.Index(wards, name='TO WARD'))
+        if drop_empty:
+            matrix = matrix.loc[values.sum(axis=1) > 0, values.sum(axis=0) > 0]
+        matrices[key[0] if len(key) == 1 else key] = matrix
+    return matrices
+
+# Most of the ward pairs of the age-group matrices (and almost all of the station pairs) have no trips at all, so the OD matrices
+# can also be kept as sparse matrices that only store the non-zero flows.
+from scipy import sparse
+
+# Sparse OD matrix (origins x destinations) backed by a CSR matrix
+# It supports adding/subtracting matrices of other years or slices, the marginals, normalization and the top flows
+# without turning it into a dense matrix, and it is saved in a compact binary format (.npz).
+class ODMatrix:
+    def __init__(self, counts, origins, destinations=None):
+        self.counts = sparse.csr_matrix(counts)
+        self.origins = pd.Index(origins, name='FROM')
+        self.destinations = self.origins.rename('TO') if destinations is None else pd.Index(destinations, name='TO')
+
+    def _check_aligned(self, other):
+        if not (self.origins.equals(other.origins) and self.destinations.equals(other.destinations)):
+            raise ValueError("OD matrices have different origins or destinations")
+
+    def __add__(self, other):
+        self._check_aligned(other)
+        return ODMatrix(self.counts + other.counts, self.origins, self.destinations)
+
+    def __sub__(self, other):
+        self._check_aligned(other)
+        return ODMatrix(self.counts - other.counts, self.origins, self.destinations)
+
+    def total(self):
+        return self.counts.sum()
+
+    # Number of trips starting in each origin (row marginals)
+    def origin_totals(self):
+        return pd.Series(np.asarray(self.counts.sum(axis=1)).ravel(), index=self.origins)
+
+    # Number of trips ending in each destination (column marginals)
+    def destination_totals(self):
+        return pd.Series(np.asarray(self.counts.sum(axis=0)).ravel(), index=self.destinations)
+
+    # Shares of the trips: of all the trips (axis=None), of each origin (axis=1) or of each destination (axis=0)
+    def normalize(self, axis=None):
+        counts = self.counts.astype('float64')
+        if axis is None:
+            return ODMatrix(counts / max(counts.sum(), 1), self.origins, self.destinations)
+        totals = np.asarray(counts.sum(axis=axis)).ravel()
+        scale = sparse.diags(np.divide(1.0, totals, out=np.zeros_like(totals), where=totals != 0))
+        counts = scale @ counts if axis == 1 else counts @ scale
+        return ODMatrix(counts, self.origins, self.destinations)
+
+    # The k largest flows as a dataframe (FROM, TO, TRIPS); with by_abs the flows are ranked by their absolute value,
+    # so that the largest decreases of a difference of two matrices are also listed
+    def top_flows(self, k=10, by_abs=False):
+        flows = self.counts.tocoo()
+        top = np.argsort(np.abs(flows.data) if by_abs else flows.data)[::-1][:k]
+        return pd.DataFrame({
+            'FROM': self.origins[flows.row[top]],
+            'TO': self.destinations[flows.col[top]],
+            'TRIPS': flows.data[top],
+        })
+
+    # Dense dataframe like the pivot tables (only for small matrices, e.g. wards)
+    def to_frame(self, drop_empty=True):
+        values = self.counts.toarray()
+        matrix = pd.DataFrame(values, index=self.origins, columns=self.destinations)
+        if drop_empty:
+            matrix = matrix.loc[(values != 0).any(axis=1), (values != 0).any(axis=0)]
+        return matrix
+
+    def save(self, path):
+        np.savez_compressed(path, data=self.counts.data, indices=self.counts.indices, indptr=self.counts.indptr,
+                            shape=self.counts.shape, origins=self.origins.to_numpy(), destinations=self.destinations.to_numpy())
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=True) as saved:
+            counts = sparse.csr_matrix((saved['data'], saved['indices'], saved['indptr']), shape=tuple(saved['shape']))
+            return cls(counts, saved['origins'], saved['destinations'])
+
+# Function for accumulating the trips of all the slices of `by` in one sparse matrix whose rows are (slice, origin)
+# It returns the matrix and the values (levels) of each slicing column.
+# `origin` and `destination` are the zone columns (wards by default, or e.g. 'FROM STATION ID' and 'TO STATION ID' with the station ids as zones).
+def stacked_od_counts(df, by=(), zones=WARDS, origin='FROM WARD', destination='TO WARD'):
+    n_zones = len(zones)
+    from_codes = zone_codes(df[origin], zones)
+    to_codes = zone_codes(df[destination], zones)
+    slice_index, valid, levels, n_slices = slice_codes(df, by)
+    valid &= (from_codes >= 0) & (to_codes >= 0)
+
+    rows = slice_index[valid] * n_zones + from_codes[valid]
+    all_counts = sparse.csr_matrix((np.ones(len(rows), dtype='int64'), (rows, to_codes[valid])),
+                                   shape=(n_slices * n_zones, n_zones))
+    return all_counts, levels
+
+# Function for computing the sparse OD matrices of every slice of `by` in one scan (the stacked matrix split by slice)
+def sparse_od_matrices(df, by=(), zones=WARDS, origin='FROM WARD', destination='TO WARD'):
+    n_zones = len(zones)
+    all_counts, levels = stacked_od_counts(df, by, zones, origin, destination)
+
+    matrices = {}
+    for position in np.ndindex(*[len(values) for values in levels.values()]):
+        key = tuple(values[i] for values, i in zip(levels.values(), position))
+        first_row = np.ravel_multi_index(position, [len(values) for values in levels.values()]) * n_zones if position else 0
+        matrix = ODMatrix(all_counts[first_row:first_row + n_zones], zones)
+        matrices[key[0] if len(key) == 1 else key] = matrix
+    return matrices
+
+# OD Matrices of all the years in one scan; I am still analysing 3 consecutive years.
+year_counts, year_levels = stage_cache("od counts", od_counts, df_MM_clean, by=["YEAR"])
+year_matrices = od_matrices(year_counts, year_levels)
+
+matrix_2016 = year_matrices[2016]
+matrix_2016
 
-matrix_age_51_60_2016
+matrix_2017 = year_matrices[2017]
+matrix_2017
 
+matrix_2018 = year_matrices[2018]
+matrix_2018
 
-age_group_above_61_2016 = df_MM_clean_2016[df_MM_clean_2016['age group'] == '61+']
-# OD Matrix
-matrix_age_above_61_2016 = (
-    age_group_above_61_2016.assign(count=1)
-    .pivot_table(index='FROM WARD', columns='TO WARD',
-                 values="count", aggfunc="count")
-    .fillna(0)
-    .astype(int)
-).sort_values('FROM WARD')
 
-matrix_age_above_61_2016
+# Saving OD Matrices (as sparse matrices in a compact binary format)
+year_od = stage_cache("year od", sparse_od_matrices, df_MM_clean, by=["YEAR"])
+year_od[2016].save("matrix_2016.npz")
+year_od[2017].save("matrix_2017.npz")
+year_od[2018].save("matrix_2018.npz")
 
+# The flows that changed the most from 2016 to 2018 (increases and decreases)
+(year_od[2018] - year_od[2016]).top_flows(10, by_abs=True)
 
 # ...........................................................................................
 
-# Drop null values
-df_MM_clean_2017 = df_MM_clean_2017.dropna(subset=['BIRTH YEAR'])
-
-# Convert BIRTH YEAR to integer
-df_MM_clean_2017['BIRTH YEAR'] = df_MM_clean_2017['BIRTH YEAR'].astype('int')
-
-# Create age groups based on the agr distribution of users
-df_MM_clean_2017['age'] = df_MM_clean_2017['YEAR'] - df_MM_clean_2017['BIRTH YEAR']
-
-# Define age groups
-age_bins = [0, 18, 30, 40, 50, 60, float('inf')]  # Define age bins/ranges
-age_labels = ['0-18', '19-30', '31-40', '41-50', '51-60', '61+']  # Define corresponding labels
-
-# Create 'age group' column using pd.cut
-df_MM_clean_2017['age group'] = pd.cut(df_MM_clean_2017['age'], bins=age_bins, labels=age_labels, right=False)
-
-age_group_under_18_2017 = df_MM_clean_2017[df_MM_clean_2017['age group'] == '0-18']
-# OD Matrix
-matrix_age_under_18_2017 = (
-    age_group_under_18_2017.assign(count=1)
-    .pivot_table(index='FROM WARD', columns='TO WARD',
-                 values="count", aggfunc="count")
-    .fillna(0)
-    .astype(int)
-).sort_values('FROM WARD')
-
-matrix_age_under_18_2017
-
-# As it is shown, the number of under 18 years old users are low and the most trips happened inside ward 28.
-
-
-age_group_19_30_2017 = df_MM_clean_2017[df_MM_clean_2017['age group'] == '19-30']
-# OD Matrix 2018 calculation using pivot table
-matrix_age_19_30_2017 = (
-    age_group_19_30_2017.assign(count=1)
-    .pivot_table(index='FROM WARD', columns='TO WARD',
-                 values="count", aggfunc="count")
-    .fillna(0)
-    .astype(int)
-).sort_values('FROM WARD')
-
-matrix_age_19_30_2017
-
-# Because the siz of the matrix is too large, it is hard to conclude here, so we will wait untile the next part for further analysis.
-
-
-age_group_31_40_2017 = df_MM_clean_2017[df_MM_clean_2017['age group'] == '31-40']
-# OD Matrix 2018 calculation using pivot table
-matrix_age_31_40_2017 = (
-    age_group_31_40_2017.assign(count=1)
-    .pivot_table(index='FROM WARD', columns='TO WARD',
-                 values="count", aggfunc="count")
-    .fillna(0)
-    .astype(int)
-).sort_values('FROM WARD')
-
-matrix_age_31_40_2017
-
-
-age_group_41_50_2017 = df_MM_clean_2017[df_MM_clean_2017['age group'] == '41-50']
-# OD Matrix 2018 calculation using pivot table
-matrix_age_41_50_2017 = (
-    age_group_41_50_2017.assign(count=1)
-    .pivot_table(index='FROM WARD', columns='TO WARD',
-                 values="count", aggfunc="count")
-    .fillna(0)
-    .astype(int)
-).sort_values('FROM WARD')
-
-matrix_age_41_50_2017
-
-
-age_group_51_60_2017 = df_MM_clean_2017[df_MM_clean_2017['age group'] == '51-60']
-# OD Matrix 2018 calculation using pivot table
-matrix_age_51_60_2017 = (
-    age_group_51_60_2017.assign(count=1)
-    .pivot_table(index='FROM WARD', columns='TO WARD',
-                 values="count", aggfunc="count")
-    .fillna(0)
-    .astype(int)
-).sort_values('FROM WARD')
-
-matrix_age_51_60_2017
-
-
-age_group_above_61_2017 = df_MM_clean_2017[df_MM_clean_2017['age group'] == '61+']
-# OD Matrix 2018 calculation using pivot table
-matrix_age_above_61_2017 = (
-    age_group_above_61_2017.assign(count=1)
-    .pivot_table(index='FROM WARD', columns='TO WARD',
-                 values="count", aggfunc="count")
-    .fillna(0)
-    .astype(int)
-).sort_values('FROM WARD')
-
-matrix_age_above_61_2017
+# Station-level flows: the ward OD matrices are too coarse for rebalancing, which needs the flows between stations.
+# The station OD of every hour is accumulated in one sparse matrix (rows = (hour, from station), columns = to station),
+# so the OD of any time window (a range of hours and/or some hours of the day) is a sum of row blocks of this matrix.
+# The departures and arrivals of every station are counted per hour of START TIME and STOP TIME respectively, so the net
+# flow (arrivals - departures) of a station in an hour is the change of the number of bikes docked at that station.
+class StationFlows:
+    def __init__(self, counts, hours, stations, departures, arrivals):
+        self.counts = counts
+        self.hours = hours
+        self.stations = stations
+        self.departures = departures
+        self.arrivals = arrivals
+
+    # Function for the flows of `trips` ("START TIME", "STOP TIME", "FROM STATION ID", "TO STATION ID"), e.g. a view of one year
+    @classmethod
+    def from_trips(cls, trips, stations=None):
+        if stations is None:
+            stations = np.union1d(trips["FROM STATION ID"].to_numpy(), trips["TO STATION ID"].to_numpy())
+        start_hours = epoch_seconds(trips["START TIME"]) // 3600
+        stop_hours = epoch_seconds(trips["STOP TIME"]) // 3600
+        hour_trips = pd.DataFrame({"HOUR": start_hours, "FROM STATION ID": trips["FROM STATION ID"].to_numpy(),
+                                   "TO STATION ID": trips["TO STATION ID"].to_numpy()})
+        counts, levels = stacked_od_counts(hour_trips, by=["HOUR"], zones=stations, origin="FROM STATION ID", destination="TO STATION ID")
+
+        # Departures and arrivals of every station in every hour from the first start to the last stop
+        first_hour = start_hours.min()
+        n_hours = max(start_hours.max(), stop_hours.max()) - first_hour + 1
+        n_stations = len(stations)
+        from_codes = zone_codes(hour_trips["FROM STATION ID"], stations)
+        to_codes = zone_codes(hour_trips["TO STATION ID"], stations)
+        departures = np.bincount(((start_hours - first_hour) * n_stations + from_codes)[from_codes >= 0],
+                                 minlength=n_hours * n_stations).reshape(n_hours, n_stations)
+        arrivals = np.bincount(((stop_hours - first_hour) * n_stations + to_codes)[to_codes >= 0],
+                               minlength=n_hours * n_stations).reshape(n_hours, n_stations)
+        all_hours = pd.DatetimeIndex(((first_hour + np.arange(n_hours)) * 3600).astype('datetime64[s]'), name="HOUR")
+        return cls(counts, pd.DatetimeIndex((np.asarray(levels["HOUR"]) * 3600).astype('datetime64[s]'), name="HOUR"),
+                   stations, pd.DataFrame(departures.astype('int32'), index=all_hours, columns=pd.Index(stations, name="STATION ID")),
+                   pd.DataFrame(arrivals.astype('int32'), index=all_hours, columns=pd.Index(stations, name="STATION ID")))
+
+    # Mask of the hours in [start, end) and in the hours of the day `hours_of_day` (all of them if None)
+    def _window(self, index, start=None, end=None, hours_of_day=None):
+        mask = np.ones(len(index), dtype=bool)
+        if start is not None:
+            mask &= index >= pd.Timestamp(start)
+        if end is not None:
+            mask &= index < pd.Timestamp(end)
+        if hours_of_day is not None:
+            mask &= np.isin(index.hour, hours_of_day)
+        return mask
+
+    # Station OD matrix of a time window
+    def od(self, start=None, end=None, hours_of_day=None):
+        n_stations = len(self.stations)
+        positions = np.flatnonzero(self._window(self.hours, start, end, hours_of_day))
+        block = self.counts[(positions[:, None] * n_stations + np.arange(n_stations)).ravel()].tocoo()
+        counts = sparse.csr_matrix((block.data, (block.row % n_stations, block.col)), shape=(n_stations, n_stations))
+        return ODMatrix(counts, self.stations)
+
+    # Net flow (arrivals - departures) of every station in every hour of a time window
+    def net_flow(self, start=None, end=None, hours_of_day=None):
+        mask = self._window(self.departures.index, start, end, hours_of_day)
+        return self.arrivals[mask] - self.departures[mask]
+
+    # The k busiest station-to-station corridors of a time window
+    def top_corridors(self, k=10, start=None, end=None, hours_of_day=None, directed=True):
+        od = self.od(start, end, hours_of_day)
+        if not directed:
+            # Both directions of a corridor together (kept in the upper triangle); the round trips of a station are on the
+            # diagonal of both matrices, so they are only counted once
+            both = od.counts + od.counts.T - sparse.diags(od.counts.diagonal(), dtype=od.counts.dtype)
+            od = ODMatrix(sparse.triu(both).tocsr(), self.stations)
+        return od.top_flows(k)
+
+# Station flows of the last year (2019), from its view of the trip store
+station_flows = stage_cache("station flows", StationFlows.from_trips, trip_columns.where(trip_columns.array("YEAR") == 2019))
+station_flows.od().save("station_od_2019.npz")
+
+# The busiest corridors of the year and of the morning peak (7-10 AM)
+station_flows.top_corridors(10)
+station_flows.top_corridors(10, hours_of_day=[7, 8, 9])
+
+# The stations that lose the most bikes in the morning peak of the working days of July 2019
+morning_net_flow = station_flows.net_flow("2019-07-01", "2019-08-01", hours_of_day=[7, 8, 9])
+morning_net_flow[morning_net_flow.index.dayofweek < 5].sum().sort_values().head(10)
 
 # ...........................................................................................
 
-# Drop null values
-df_MM_clean_2018 = df_MM_clean_2018.dropna(subset=['BIRTH YEAR'])
-
-# Convert BIRTH YEAR to integer
-df_MM_clean_2018['BIRTH YEAR'] = df_MM_clean_2018['BIRTH YEAR'].astype('int')
-
-# Create age groups based on the agr distribution of users
-df_MM_clean_2018['age'] = df_MM_clean_2017['YEAR'] - df_MM_clean_2017['BIRTH YEAR']
-
-# Define age groups
-age_bins = [0, 18, 30, 40, 50, 60, float('inf')]  # Define age bins/ranges
-age_labels = ['0-18', '19-30', '31-40', '41-50', '51-60', '61+']  # Define corresponding labels
-
-# Create 'age group' column using pd.cut
-df_MM_clean_2018['age group'] = pd.cut(df_MM_clean_2018['age'], bins=age_bins, labels=age_labels, right=False)
-
-
-age_group_under_18_2018 = df_MM_clean_2018[df_MM_clean_2018['age group'] == '0-18']
-# OD Matrix 2018 calculation using pivot table
-matrix_age_under_18_2018 = (
-    age_group_under_18_2018.assign(count=1)
-    .pivot_table(index='FROM WARD', columns='TO WARD',
-                 values="count", aggfunc="count")
-    .fillna(0)
-    .astype(int)
-).sort_values('FROM WARD')
-
-matrix_age_under_18_2018
+# Every new data pull meant running the whole analysis again, even if only one month was new. So I am keeping the aggregates
+# of every month (OD counts, number of start/end trips per ward and per-bike partials for the utilization) in a store.
+# A new month is added by processing only its own trips, and the yearly or multi-year results are sums of the stored months.
+AGGREGATE_STORE = "aggregate_store"
+
+# Function for computing the aggregates of the trips of one month: OD matrix, number of start/end trips per ward, per-bike partials
+# and daily sketches of the bikes
+def aggregate_trips(trips, wards=WARDS):
+    od = sparse_od_matrices(trips, zones=wards)[()]
+    ward_counts = pd.DataFrame({"START TRIPS": od.origin_totals().to_numpy(),
+                                "END TRIPS": od.destination_totals().to_numpy()},
+                               index=pd.Index(wards, name="WARD"))
+    bikes = trips.astype({"TRIP DURATION": 'float64'}).groupby("BIKE ID").agg(**{"TRIP DURATION": ("TRIP DURATION", "sum"),
+                                                                                 "TRIPS": ("TRIP DURATION", "size"),
+                                                                                 "START TIME": ("START TIME", "min"),
+                                                                                 "STOP TIME": ("STOP TIME", "max")})
+    return od, ward_counts, bikes, BikeSketches.from_trips(trips)
+
+# Incremental store of monthly aggregates (one folder per month: od.npz, wards.parquet, bikes.parquet, bike_sketches.npz)
+class AggregateStore:
+    def __init__(self, path=AGGREGATE_STORE, wards=WARDS):
+        self.path = path
+        self.wards = wards
+        os.makedirs(path, exist_ok=True)
+
+    def _month_path(self, year, month):
+        return os.path.join(self.path, f"{year:04d}-{month:02d}")
+
+    # Stored (year, month) pairs
+    def months(self, years=None, months=None):
+        stored = sorted(tuple(int(part) for part in name.split("-")) for name in os.listdir(self.path) if len(name) == 7)
+        return [(year, month) for year, month in stored
+                if (years is None or year in years) and (months is None or month in months)]
+
+    # Adding the trips of one or more months (with "FROM WARD", "TO WARD", "BIKE ID", "TRIP DURATION", "START TIME" and "STOP TIME")
+    # With replace=True the months of `df` replace the stored ones (e.g. a corrected data pull), otherwise they are added to them.
+    def ingest(self, df, replace=True):
+        start_time = parse_divvy_time(df["START TIME"])
+        stop_time = parse_divvy_time(df["STOP TIME"])
+        month_keys = (start_time.dt.year * 100 + start_time.dt.month).to_numpy()
+
+        for month_key in np.unique(month_keys):
+            in_month = month_keys == month_key
+            month_trips = df[in_month].assign(**{"START TIME": start_time[in_month], "STOP TIME": stop_time[in_month]})
+            year, month = divmod(int(month_key), 100)
+            self.write_month(year, month, *aggregate_trips(month_trips, self.wards), replace=replace)
+
+    # Storing the aggregates of one month (computed by aggregate_trips)
+    def write_month(self, year, month, od, ward_counts, bikes, sketches, replace=True):
+        month_path = self._month_path(year, month)
+        if not replace and os.path.exists(month_path):
+            od = od + self._read_od(month_path)
+            ward_counts = ward_counts.add(pd.read_parquet(os.path.join(month_path, "wards.parquet")), fill_value=0)
+            bikes = self._merge_bikes([bikes, pd.read_parquet(os.path.join(month_path, "bikes.parquet"))])
+            sketches = sketches + BikeSketches.load(os.path.join(month_path, "bike_sketches.npz"))
+
+        os.makedirs(month_path, exist_ok=True)
+        od.save(os.path.join(month_path, "od.npz"))
+        ward_counts.astype('int64').to_parquet(os.path.join(month_path, "wards.parquet"))
+        bikes.to_parquet(os.path.join(month_path, "bikes.parquet"))
+        sketches.save(os.path.join(month_path, "bike_sketches.npz"))
+
+    @staticmethod
+    def _merge_bikes(partials):
+        return pd.concat(partials).groupby(level="BIKE ID").agg({"TRIP DURATION": "sum", "TRIPS": "sum",
+                                                                 "START TIME": "min", "STOP TIME": "max"})
+
+    @staticmethod
+    def _read_od(month_path):
+        return ODMatrix.load(os.path.join(month_path, "od.npz"))
+
+    # OD matrix of the selected months (sum of the monthly OD matrices)
+    def od(self, years=None, months=None):
+        total = ODMatrix(sparse.csr_matrix((len(self.wards), len(self.wards)), dtype='int64'), self.wards)
+        for year, month in self.months(years, months):
+            total = total + self._read_od(self._month_path(year, month))
+        return total
+
+    # Number of start and end trips per ward of the selected months
+    def ward_counts(self, years=None, months=None):
+        partials = [pd.read_parquet(os.path.join(self._month_path(year, month), "wards.parquet"))
+                    for year, month in self.months(years, months)]
+        return pd.concat(partials).groupby(level="WARD").sum()
+
+    # Per-bike partials of the selected months (total trip duration, number of trips, first start and last stop)
+    def bike_partials(self, years=None, months=None):
+        return self._merge_bikes([pd.read_parquet(os.path.join(self._month_path(year, month), "bikes.parquet"))
+                                  for year, month in self.months(years, months)])
+
+    # Daily sketches of the bikes of the selected months (e.g. aggregate_store.bike_sketches(years=[2019]).distinct(["MONTH"]))
+    def bike_sketches(self, years=None, months=None):
+        sketches = [BikeSketches.load(os.path.join(self._month_path(year, month), "bike_sketches.npz"))
+                    for year, month in self.months(years, months)]
+        return BikeSketches(np.concatenate([sketch.days for sketch in sketches]),
+                            np.concatenate([sketch.registers for sketch in sketches]))
+
+# Filling the store with the cleaned trips. For a new monthly drop, only its trips are needed: aggregate_store.ingest(new_month_trips)
+# The cleaned trips are only aggregated again when they changed, as for the trip store and the Parquet cache.
+aggregate_store = AggregateStore()
+stage_cache.store("aggregate store", AGGREGATE_STORE, aggregate_store.ingest, df_MM_clean)
+
+# The distinct bikes of periods made of several stored months are estimated from their sketches, without the trips
+aggregate_store.bike_sketches().distinct(["YEAR"])
 
+# ...........................................................................................
 
-age_group_19_30_2018 = df_MM_clean_2018[df_MM_clean_2018['age group'] == '19-30']
-# OD Matrix 2018 calculation using pivot table
-matrix_age_19_30_2018 = (
-    age_group_19_30_2018.assign(count=1)
-    .pivot_table(index='FROM WARD', columns='TO WARD',
-                 values="count", aggfunc="count")
-    .fillna(0)
-    .astype(int)
-).sort_values('FROM WARD')
+# Because of the memory issues, I could previously only work on 3 years. The whole history (2013-2019) can also be processed
+# out of core, without ever loading all the trips: the trips file is read chunk by chunk and the cleaned trips are spilled
+# into the Parquet cache. Then every month of the cache is joined with the wards and aggregated into the aggregate store.
+
+# The months are independent of each other, so they are processed in parallel by a pool of worker processes. The ward
+# polygons and the station -> ward table are shared with the workers read-only: with the "fork" start method the workers
+# inherit them from the main process, otherwise they are sent once to each worker (never with every task).
+import multiprocessing
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+_shared_with_workers = {}
+
+def _init_worker(shared):
+    _shared_with_workers.update(shared)
+
+# Function run by the workers for one month of the cache: join the trips with the wards, save them back into their partition
+# and return the aggregates of the month
+def _process_cached_month(cache_path, year, month, wards):
+    trips = read_trip_cache(cache_path, years=[year], months=[month])
+    # Only the stations that are missing in the shared table are joined with the ward polygons
+    station_wards = update_station_wards(trips, _shared_with_workers["ward_index"], _shared_with_workers["station_wards"])
+    trips = add_trip_wards(trips, station_wards)
+    write_trip_cache(trips, cache_path)
+    return year, month, aggregate_trips(trips, wards)
+
+# Function for joining every month of the cache with the wards and aggregating it into `store`, with `workers` processes (all the cores if None)
+# The partial results of the workers are merged into the store by the main process.
+def process_cached_months(cache_path, ward_index, station_wards, store, workers=None):
+    shared = {"ward_index": ward_index, "station_wards": station_wards}
+    if "fork" in multiprocessing.get_all_start_methods():
+        _shared_with_workers.update(shared)
+        pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("fork"))
+    else:
+        pool = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(shared,))
+
+    with pool:
+        tasks = [pool.submit(_process_cached_month, cache_path, year, month, store.wards)
+                 for year, month in trip_cache_months(cache_path)]
+        for task in as_completed(tasks):
+            year, month, aggregates = task.result()
+            store.write_month(year, month, *aggregates)
+    return store
+
+# Approximate memory of one row of the trips file while it is parsed and cleaned (strings included), used to size the chunks
+RAW_ROW_BYTES = 1000
+# Approximate memory of one trip of the cache while a worker joins its month with the wards and aggregates it (the compact
+# trip and its intermediate copies), used to limit the number of workers
+CACHED_ROW_BYTES = 4 * TRIP_BYTES_TARGET
+
+# Function for running the pipeline (clean -> calendar columns -> wards -> OD / ward counts / utilization partials) out of core
+# The chunks are sized so that a chunk and its intermediate copies stay within `memory_budget_mb`; only one chunk (pass 1)
+# or one month per worker (pass 2) is in memory at any time, so the workers are also limited to the number of the largest
+# months that fit in `memory_budget_mb`.
+def run_out_of_core(input_path, ward_index, memory_budget_mb=8192, cache_path=TRIP_CACHE, store_path=AGGREGATE_STORE, workers=None):
+    chunksize = max(10_000, int(memory_budget_mb * 2**20 / 4 / RAW_ROW_BYTES))
+    columns = list(dict.fromkeys(column for stage_columns in TRIP_COLUMNS.values() for column in stage_columns))
+
+    # Pass 1: clean the chunks and spill them into the cache; the new stations are joined with the wards on the way
+    if os.path.exists(cache_path):
+        shutil.rmtree(cache_path)
+    station_wards = read_station_wards()
+    month_rows = Counter()
+    for chunk in read_trips_in_chunks(input_path, columns=columns, chunksize=chunksize):
+        chunk = compact_trips(add_calendar_features(chunk))
+        chunk = keep_valid_trips(chunk, check_rules(chunk))
+        station_wards = update_station_wards(chunk, ward_index, station_wards)
+        write_trip_cache(chunk, cache_path, append=True)
+        month_rows.update(chunk.value_counts(["YEAR", "MONTH"]).to_dict())
+    station_wards.to_parquet(STATION_WARDS, index=False)
+
+    # Pass 2: join the months with the wards and aggregate them, in parallel (one month per worker in memory)
+    max_workers = max(1, int(memory_budget_mb * 2**20 // (max(month_rows.values(), default=1) * CACHED_ROW_BYTES)))
+    workers = min(workers or os.cpu_count(), max_workers)
+    return process_cached_months(cache_path, ward_index, station_wards, AggregateStore(store_path), workers=workers)
+
+#aggregate_store = run_out_of_core(input_micro_mobility, ward_index, memory_budget_mb=8192)
 
-matrix_age_19_30_2018
+# ...........................................................................................
 
+# - Prepare OD matrices for different years and different age groups(3 OD matrices for each age-group of 3 consecutive years). Are there any periodicity or trends noticed? Is there a difference between the OD matrices for different age groups?
 
-age_group_31_40_2018 = df_MM_clean_2018[df_MM_clean_2018['age group'] == '31-40']
-# OD Matrix 2018 calculation using pivot table
-matrix_age_31_40_2018 = (
-    age_group_31_40_2018.assign(count=1)
-    .pivot_table(index='FROM WARD', columns='TO WARD',
-                 values="count", aggfunc="count")
-    .fillna(0)
-    .astype(int)
-).sort_values('FROM WARD')
+# Using the cached trips with "from wards" and "to wards" to avoid kernel disconnecting (only the needed years and columns are read).
+age_od_columns = ["YEAR", "BIRTH YEAR", "FROM WARD", "TO WARD", "RULE FLAGS"]
 
-matrix_age_31_40_2018
+# Function for the OD counts of every year and age group in one scan (memoized with the cache and the age groups as inputs)
+def age_od_counts(cache_path, years, age_bins, age_labels):
+    df_MM_clean_age = read_trip_cache(cache_path, years=years, columns=age_od_columns)
 
+    # Keep the trips with a birth year (from the rule flags)
+    df_MM_clean_age = df_MM_clean_age[passes(df_MM_clean_age["RULE FLAGS"], ["birth year"])]
 
-age_group_41_50_2018 = df_MM_clean_2018[df_MM_clean_2018['age group'] == '41-50']
-# OD Matrix 2018 calculation using pivot table
-matrix_age_41_50_2018 = (
-    age_group_41_50_2018.assign(count=1)
-    .pivot_table(index='FROM WARD', columns='TO WARD',
-                 values="count", aggfunc="count")
-    .fillna(0)
-    .astype(int)
-).sort_values('FROM WARD')
+    # Convert BIRTH YEAR to integer
+    df_MM_clean_age['BIRTH YEAR'] = df_MM_clean_age['BIRTH YEAR'].astype('int')
 
-matrix_age_41_50_2018
+    # Create age groups based on the agr distribution of users
+    df_MM_clean_age['age'] = df_MM_clean_age['YEAR'] - df_MM_clean_age['BIRTH YEAR']
 
+    # Create 'age group' column with the age groups defined in section 1
+    df_MM_clean_age['age group'] = Binning.from_edges(age_bins, age_labels, size=121).apply(df_MM_clean_age['age'])
 
-age_group_51_60_2018 = df_MM_clean_2018[df_MM_clean_2018['age group'] == '51-60']
-# OD Matrix 2018 calculation using pivot table
-matrix_age_51_60_2018 = (
-    age_group_51_60_2018.assign(count=1)
-    .pivot_table(index='FROM WARD', columns='TO WARD',
-                 values="count", aggfunc="count")
-    .fillna(0)
-    .astype(int)
-).sort_values('FROM WARD')
+    return od_counts(df_MM_clean_age, by=["YEAR", "age group"])
 
-matrix_age_51_60_2018
+# OD Matrices of every year and age group
+age_counts, age_levels = stage_cache("age od counts", age_od_counts, TRIP_CACHE, [2016, 2017, 2018], age_bins, age_labels)
+age_matrices = od_matrices(age_counts, age_levels)
 
+matrix_age_under_18_2016 = age_matrices[(2016, '0-18')]
+matrix_age_under_18_2016
 
-age_group_above_61_2018 = df_MM_clean_2018[df_MM_clean_2018['age group'] == '61+']
-# OD Matrix 2018 calculation using pivot table
-matrix_age_above_61_2018 = (
-    age_group_above_61_2018.assign(count=1)
-    .pivot_table(index='FROM WARD', columns='TO WARD',
-                 values="count", aggfunc="count")
-    .fillna(0)
-    .astype(int)
-).sort_values('FROM WARD')
+# It shows the OD matrix of under-18 age group users in 2016
 
-matrix_age_above_61_2018
+matrix_age_19_30_2016 = age_matrices[(2016, '19-30')]
+matrix_age_31_40_2016 = age_matrices[(2016, '31-40')]
+matrix_age_41_50_2016 = age_matrices[(2016, '41-50')]
+matrix_age_51_60_2016 = age_matrices[(2016, '51-60')]
+matrix_age_above_61_2016 = age_matrices[(2016, '61+')]
+
+matrix_age_under_18_2017 = age_matrices[(2017, '0-18')]
+matrix_age_19_30_2017 = age_matrices[(2017, '19-30')]
+matrix_age_31_40_2017 = age_matrices[(2017, '31-40')]
+matrix_age_41_50_2017 = age_matrices[(2017, '41-50')]
+matrix_age_51_60_2017 = age_matrices[(2017, '51-60')]
+matrix_age_above_61_2017 = age_matrices[(2017, '61+')]
+
+matrix_age_under_18_2018 = age_matrices[(2018, '0-18')]
+matrix_age_19_30_2018 = age_matrices[(2018, '19-30')]
+matrix_age_31_40_2018 = age_matrices[(2018, '31-40')]
+matrix_age_41_50_2018 = age_matrices[(2018, '41-50')]
+matrix_age_51_60_2018 = age_matrices[(2018, '51-60')]
+matrix_age_above_61_2018 = age_matrices[(2018, '61+')]
 
 # ...........................................................................................
 
@@ -834,154 +1929,150 @@ sns.heatmap(matrix_age_above_61_2018,cmap='crest')
 # ...........................................................................................
 
 # - Create a flowmap for the OD matrices.
-# 2016
-import pandas as pd
 import networkx as nx
 import matplotlib.pyplot as plt
-import seaborn as sns
-
-matrix_2016.index = matrix_2016.index.astype(int)
-matrix_2016.columns = matrix_2016.columns.astype(int)
-
-# Create a directed graph from the OD matrix
-G = nx.DiGraph()
-
-# Add nodes
-for node in matrix_2016.index:
-    G.add_node(node)
-
-# Add edges
-for from_node in matrix_2016.index:
-    for to_node in matrix_2016.columns:
-        weight = matrix_2016.loc[from_node, to_node]
-        if weight > 0:
-            G.add_edge(from_node, to_node, weight=weight)
-
-# Draw the graph with a circular layout
-pos = nx.circular_layout(G)
-
-# Set node colors based on degree (number of connections)
-node_colors = [G.degree(node) for node in G.nodes]
-
-# Set edge colors based on weights
-edge_colors = [G[from_node][to_node]['weight'] for from_node, to_node in G.edges]
-
-# Draw nodes
-nx.draw_networkx_nodes(G, pos, node_size=700, node_color=node_colors, cmap=plt.cm.Blues)
-
-# Draw edges with weights
-nx.draw_networkx_edges(G, pos, width=1, edge_color=edge_colors, edge_cmap=plt.cm.Greens, arrowsize=10)
-
-# Add labels
-nx.draw_networkx_labels(G, pos, font_size=8, font_color='black', font_weight='bold')
-
-# Add colorbar for edge weights
-edge_weights = nx.get_edge_attributes(G, 'weight')
-cbar = plt.colorbar()
-cbar.set_label('Flow Counts')
-
-plt.title("Flowmap for OD Matrix 2017")
-plt.show()
-
-
-# 2017
-import pandas as pd
-import networkx as nx
-import matplotlib.pyplot as plt
-import seaborn as sns
-
-matrix_2017.index = matrix_2017.index.astype(int)
-matrix_2017.columns = matrix_2017.columns.astype(int)
-
-# Create a directed graph from the OD matrix
-G = nx.DiGraph()
-
-# Add nodes
-for node in matrix_2017.index:
-    G.add_node(node)
-
-# Add edges
-for from_node in matrix_2017.index:
-    for to_node in matrix_2017.columns:
-        weight = matrix_2017.loc[from_node, to_node]
-        if weight > 0:
-            G.add_edge(from_node, to_node, weight=weight)
-
-# Draw the graph with a circular layout
-pos = nx.circular_layout(G)
-
-# Set node colors based on degree (number of connections)
-node_colors = [G.degree(node) for node in G.nodes]
-
-# Set edge colors based on weights
-edge_colors = [G[from_node][to_node]['weight'] for from_node, to_node in G.edges]
-
-# Draw nodes
-nx.draw_networkx_nodes(G, pos, node_size=700, node_color=node_colors, cmap=plt.cm.Blues)
-
-# Draw edges with weights
-nx.draw_networkx_edges(G, pos, width=1, edge_color=edge_colors, edge_cmap=plt.cm.Greens, arrowsize=10)
-
-# Add labels
-nx.draw_networkx_labels(G, pos, font_size=8, font_color='black', font_weight='bold')
-
-# Add colorbar for edge weights
-edge_weights = nx.get_edge_attributes(G, 'weight')
-cbar = plt.colorbar()
-cbar.set_label('Flow Counts')
-
-plt.title("Flowmap for OD Matrix 2017")
-plt.show()
+from matplotlib.collections import LineCollection
+
+# Previously, the graphs were built by reading every cell of the OD matrix with .loc, and the wards were placed on a circle.
+# Now the OD matrix is turned into an edge list in one step, the wards are placed at their centroids and the flows are drawn
+# directly as a LineCollection (the edge list can also be turned into a networkx graph with flow_graph).
+
+# Function for turning an OD matrix (dataframe or ODMatrix) into an edge list (FROM, TO, TRIPS), sorted from the largest flow
+# Only the flows with at least `min_trips` trips are kept and, if `top_k` is given, only the k largest ones.
+def od_edges(matrix, top_k=None, min_trips=1):
+    if isinstance(matrix, ODMatrix):
+        flows = matrix.counts.tocoo()
+        origins, destinations, trips = matrix.origins[flows.row], matrix.destinations[flows.col], flows.data
+    else:
+        values = matrix.to_numpy()
+        rows, columns = np.nonzero(values)
+        origins, destinations, trips = matrix.index[rows], matrix.columns[columns], values[rows, columns]
+
+    edges = pd.DataFrame({'FROM': np.asarray(origins), 'TO': np.asarray(destinations), 'TRIPS': trips})
+    edges = edges[edges['TRIPS'] >= min_trips].sort_values('TRIPS', ascending=False, ignore_index=True)
+    return edges if top_k is None else edges.head(top_k)
+
+# Function for building a directed networkx graph from an edge list
+def flow_graph(edges):
+    return nx.from_pandas_edgelist(edges, 'FROM', 'TO', edge_attr='TRIPS', create_using=nx.DiGraph)
+
+# Function for the positions (x, y) of the wards: the centroids of their polygons
+def ward_centroids(ward_index):
+    centroids = shapely.centroid(ward_index["geometry"])
+    return pd.DataFrame({'x': shapely.get_x(centroids), 'y': shapely.get_y(centroids)}, index=pd.Index(ward_index["ward"], name='WARD'))
+
+# Function for drawing a flowmap of an edge list on `ax`, with the nodes at `positions` (dataframe with x and y)
+# The flows are drawn in one LineCollection (colour and width by number of trips) and the nodes are sized by their outgoing trips.
+def draw_flowmap(edges, positions, ax=None, title=None, labels=True):
+    ax = ax if ax is not None else plt.gca()
+    edges = edges.sort_values('TRIPS')
+    trips = edges['TRIPS'].to_numpy(dtype='float64')
+
+    from_xy = positions.reindex(edges['FROM']).to_numpy()
+    to_xy = positions.reindex(edges['TO']).to_numpy()
+    lines = LineCollection(np.stack([from_xy, to_xy], axis=1), array=trips, cmap=plt.cm.Greens,
+                           linewidths=0.5 + 3 * trips / max(trips.max(), 1))
+    ax.add_collection(lines)
+
+    node_trips = edges.groupby('FROM')['TRIPS'].sum().reindex(positions.index, fill_value=0)
+    ax.scatter(positions['x'], positions['y'], s=20 + 300 * node_trips / max(node_trips.max(), 1),
+               c=node_trips, cmap=plt.cm.Blues, edgecolors='grey', zorder=2)
+    if labels:
+        for node, (x, y) in positions.iterrows():
+            ax.annotate(str(node), (x, y), fontsize=8, fontweight='bold', ha='center', va='center', zorder=3)
+
+    cbar = plt.colorbar(lines, ax=ax)
+    cbar.set_label('Flow Counts')
+    ax.set_aspect('equal')
+    ax.autoscale()
+    if title is not None:
+        ax.set_title(title)
+    return ax
+
+ward_positions = ward_centroids(ward_index)
+
+# Flowmaps of 2016, 2017 and 2018 (only the 300 largest flows to keep the maps readable)
+for year, matrix in [(2016, matrix_2016), (2017, matrix_2017), (2018, matrix_2018)]:
+    fig, ax = plt.subplots(figsize=(10, 12))
+    draw_flowmap(od_edges(matrix, top_k=300), ward_positions, ax=ax, title=f"Flowmap for OD Matrix {year}")
+    plt.show()
 
+# ...........................................................................................
 
-# 2018
-import pandas as pd
-import networkx as nx
-import matplotlib.pyplot as plt
+# For the report, all the heatmaps and flowmaps are rendered into files at once instead of being shown one at a time.
+# The figures are rendered by worker processes with a non-interactive backend (each worker reuses one figure), and a figure
+# is only rendered again when its matrix changed: the hash of each rendered matrix is kept in a manifest next to the files.
+import hashlib
+import json
 import seaborn as sns
 
-matrix_2018.index = matrix_2018.index.astype(int)
-matrix_2018.columns = matrix_2018.columns.astype(int)
-
-# Create a directed graph from the OD matrix
-G = nx.DiGraph()
-
-# Add nodes
-for node in matrix_2018.index:
-    G.add_node(node)
-
-# Add edges
-for from_node in matrix_2018.index:
-    for to_node in matrix_2018.columns:
-        weight = matrix_2018.loc[from_node, to_node]
-        if weight > 0:
-            G.add_edge(from_node, to_node, weight=weight)
-
-# Draw the graph with a circular layout
-pos = nx.circular_layout(G)
+FIGURES_FOLDER = "figures"
 
-# Set node colors based on degree (number of connections)
-node_colors = [G.degree(node) for node in G.nodes]
+_worker_figure = {}
 
-# Set edge colors based on weights
-edge_colors = [G[from_node][to_node]['weight'] for from_node, to_node in G.edges]
+def _init_render_worker():
+    plt.switch_backend('Agg')
 
-# Draw nodes
-nx.draw_networkx_nodes(G, pos, node_size=700, node_color=node_colors, cmap=plt.cm.Blues)
+# Function for the hash of a matrix and of the way it is rendered (kind of figure and file format)
+def render_hash(matrix, kind, fmt):
+    digest = hashlib.sha256(f"{kind}|{fmt}".encode())
+    digest.update(pd.util.hash_pandas_object(matrix, index=True).to_numpy().tobytes())
+    digest.update(pd.util.hash_pandas_object(matrix.columns.to_series(), index=False).to_numpy().tobytes())
+    return digest.hexdigest()
 
-# Draw edges with weights
-nx.draw_networkx_edges(G, pos, width=1, edge_color=edge_colors, edge_cmap=plt.cm.Greens, arrowsize=10)
+# Function run by the workers: render one heatmap or flowmap into `path`
+def _render_od_figure(name, kind, matrix, path, positions):
+    if "figure" not in _worker_figure:
+        _worker_figure["figure"] = plt.figure(figsize=(10, 10))
+    figure = _worker_figure["figure"]
+    figure.clf()
+    ax = figure.add_subplot()
 
-# Add labels
-nx.draw_networkx_labels(G, pos, font_size=8, font_color='black', font_weight='bold')
-
-# Add colorbar for edge weights
-edge_weights = nx.get_edge_attributes(G, 'weight')
-cbar = plt.colorbar()
-cbar.set_label('Flow Counts')
-
-plt.title("Flowmap for OD Matrix 2017")
-plt.show()
+    if kind == 'heatmap':
+        sns.heatmap(matrix, cmap='crest', ax=ax)
+        ax.set_title(f"OD Matrix {name}")
+    else:
+        draw_flowmap(od_edges(matrix, top_k=300), positions, ax=ax, title=f"Flowmap for OD Matrix {name}")
+    figure.savefig(path)
+    return path
+
+# Function for rendering the heatmaps and/or flowmaps of the OD matrices (dict of name -> matrix) into `folder`
+# Only the figures whose matrix (or kind/format) changed since the last run are rendered. It returns the paths of the rendered files.
+def render_od_figures(matrices, positions=None, folder=FIGURES_FOLDER, kinds=('heatmap', 'flowmap'), fmt='png', workers=None):
+    os.makedirs(folder, exist_ok=True)
+    manifest_path = os.path.join(folder, "manifest.json")
+    manifest = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as manifest_file:
+            manifest = json.load(manifest_file)
+
+    jobs = {}
+    for name, matrix in matrices.items():
+        if isinstance(matrix, ODMatrix):
+            matrix = matrix.to_frame()
+        for kind in kinds:
+            path = os.path.join(folder, f"{kind}_{name}.{fmt}")
+            matrix_hash = render_hash(matrix, kind, fmt)
+            if manifest.get(path) != matrix_hash or not os.path.exists(path):
+                jobs[path] = (name, kind, matrix, matrix_hash)
+
+    context = multiprocessing.get_context("fork") if "fork" in multiprocessing.get_all_start_methods() else None
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=_init_render_worker) as pool:
+        tasks = {pool.submit(_render_od_figure, name, kind, matrix, path, positions): (path, matrix_hash)
+                 for path, (name, kind, matrix, matrix_hash) in jobs.items()}
+        for task in as_completed(tasks):
+            path, matrix_hash = tasks[task]
+            task.result()
+            manifest[path] = matrix_hash
+
+    with open(manifest_path, "w") as manifest_file:
+        json.dump(manifest, manifest_file, indent=1)
+    return list(jobs)
+
+# All the OD matrices of this section (general and per age group)
+report_matrices = {str(year): year_matrices[year] for year in [2016, 2017, 2018]}
+report_matrices.update({f"{age_group}_{year}": matrix for (year, age_group), matrix in age_matrices.items()})
+render_od_figures(report_matrices, positions=ward_positions)
 
 
 # # 3 - Relation to Public transport line
@@ -991,71 +2082,43 @@ plt.show()
 # Group data by wards in order to be used into QGIS for further analysis.
 import pandas as pd
 
-df_MM_clean_2016 = pd.read_csv('df_MM_clean_2016', on_bad_lines = 'warn', sep=',')
-df_MM_clean_2017 = pd.read_csv('df_MM_clean_2017', on_bad_lines = 'warn', sep=',')
-df_MM_clean_2018 = pd.read_csv('df_MM_clean_2018', on_bad_lines = 'warn', sep=',')
-
-
-number_of_start_trips = df_MM_clean_2016.groupby("FROM WARD").size().reset_index(name='number_of_start_trips_2016')
-number_of_start_trips.to_csv("number_of_start_trips_2016", index=False)
-
-number_of_start_trips_2017 = df_MM_clean_2017.groupby("FROM WARD").size().reset_index(name='number_of_start_trips_2017')
-number_of_start_trips_2017.to_csv("number_of_start_trips_2017", index=False)
+# The number of start and end trips per ward come from the aggregate store, without scanning the trips again
+for year in [2016, 2017, 2018, 2019]:
+    ward_counts = aggregate_store.ward_counts(years=[year])
 
-number_of_start_trips_2018 = df_MM_clean_2018.groupby("FROM WARD").size().reset_index(name='number_of_start_trips_2018')
-number_of_start_trips_2018.to_csv("number_of_start_trips_2018", index=False)
+    number_of_start_trips = ward_counts.loc[ward_counts["START TRIPS"] > 0, "START TRIPS"].rename_axis("FROM WARD")
+    number_of_start_trips.reset_index(name=f'number_of_start_trips_{year}').to_csv(f"number_of_start_trips_{year}", index=False)
 
-
-number_of_end_trips_2016 = df_MM_clean_2016.groupby("TO WARD").size().reset_index(name='number_of_end_trips_2016')
-number_of_end_trips_2016.to_csv("number_of_end_trips_2016", index=False)
-
-number_of_end_trips_2017 = df_MM_clean_2017.groupby("TO WARD").size().reset_index(name='number_of_end_trips_2017')
-number_of_end_trips_2017.to_csv("number_of_end_trips_2017", index=False)
-
-number_of_end_trips_2018 = df_MM_clean_2018.groupby("TO WARD").size().reset_index(name='number_of_end_trips_2018')
-number_of_end_trips_2018.to_csv("number_of_end_trips_2018", index=False)
-
-
-df_MM_clean_2019 = pd.read_csv('df_2019.csv', on_bad_lines = 'warn', sep=',')
-number_of_start_trips_2019 = df_MM_clean_2019.groupby("FROM WARD").size().reset_index(name='number_of_start_trips_2019')
-number_of_start_trips_2019.to_csv("number_of_start_trips_2019", index=False)
-number_of_end_trips_2019 = df_MM_clean_2019.groupby("TO WARD").size().reset_index(name='number_of_start_trips_2019')
-number_of_end_trips_2019.to_csv("number_of_end_trips_2019", index=False)
+    number_of_end_trips = ward_counts.loc[ward_counts["END TRIPS"] > 0, "END TRIPS"].rename_axis("TO WARD")
+    number_of_end_trips.reset_index(name=f'number_of_end_trips_{year}').to_csv(f"number_of_end_trips_{year}", index=False)
 
 # -------------------------------------------------------------------------------------------
 
 # Here, I am dividing a day into 3 day times (Day, Evening and Night) to do some analysis based on the time of trips in QGIS software.
 
-# day time
-df_MM_clean_2016_time = pd.to_datetime(df_MM_clean_2016['START TIME'], format="%m/%d/%Y %I:%M:%S %p")
-df_MM_clean_2017_time = pd.to_datetime(df_MM_clean_2017['START TIME'], format="%m/%d/%Y %I:%M:%S %p")
-df_MM_clean_2018_time = pd.to_datetime(df_MM_clean_2018['START TIME'], format="%m/%d/%Y %I:%M:%S %p")
-
-
-import datetime as dt
-df_MM_clean_2016["HOUR"] = df_MM_clean_2016_time.dt.strftime("%H")
-df_MM_clean_2017["HOUR"] = df_MM_clean_2017_time.dt.strftime("%H")
-df_MM_clean_2018["HOUR"] = df_MM_clean_2018_time.dt.strftime("%H")
+# day time (the cached "HOUR" column is already an integer from 0 to 23)
 
 # Function for day time
 def day_time(hour):
-    if  hour=='00' or hour=='01' or hour=='02' or hour=='03' or hour=='04' or hour=='05' or hour=='06' or hour=='07':
+    if hour < 8:
         return 'Night'
-    elif hour=='08' or hour=='09' or hour=='10' or hour=='11' or hour=='12' or hour=='13' or hour=='14' or hour=='15':
+    elif hour < 16:
         return 'Day'
-    elif hour=='16' or hour=='17' or hour=='18' or hour=='19' or hour=='20' or hour=='21' or hour=='22' or hour=='23':
+    else:
         return 'Evening'
 
-df_MM_clean_2016["DAY_TIME"] = df_MM_clean_2016["HOUR"].apply(day_time)
-df_MM_clean_2017["DAY_TIME"] = df_MM_clean_2017["HOUR"].apply(day_time)
-df_MM_clean_2018["DAY_TIME"] = df_MM_clean_2018["HOUR"].apply(day_time)
+# Day time of each hour, computed once for the 24 hours
+DAY_TIME_BINNING = Binning.from_function(day_time, ['Night', 'Day', 'Evening'], size=24)
+
+# The day time is derived from the HOUR of the cells of the ward cube, and the trips per ward and day time are roll-ups of the cube
+TripCube.DERIVED["DAY_TIME"] = lambda cube: DAY_TIME_BINNING.apply(cube.column("HOUR"))
 
-df_MM_clean_2016.head()
+ward_cube.cells.head()
 
 
-group_day_time_2016 = df_MM_clean_2016.groupby(["FROM WARD", "DAY_TIME"]).size().reset_index(name='group_day_time_2016')
-group_day_time_2017 = df_MM_clean_2017.groupby(["FROM WARD", "DAY_TIME"]).size().reset_index(name='group_day_time_2017')
-group_day_time_2018 = df_MM_clean_2018.groupby(["FROM WARD", "DAY_TIME"]).size().reset_index(name='group_day_time_2018')
+group_day_time_2016 = ward_cube.rollup(["FROM WARD", "DAY_TIME"], where={"YEAR": 2016}).reset_index(name='group_day_time_2016')
+group_day_time_2017 = ward_cube.rollup(["FROM WARD", "DAY_TIME"], where={"YEAR": 2017}).reset_index(name='group_day_time_2017')
+group_day_time_2018 = ward_cube.rollup(["FROM WARD", "DAY_TIME"], where={"YEAR": 2018}).reset_index(name='group_day_time_2018')
 
 group_day_time_2016.to_csv("group_day_time_2016", index=False)
 group_day_time_2017.to_csv("group_day_time_2017", index=False)
@@ -1067,18 +2130,89 @@ group_day_time_2018.to_csv("group_day_time_2018", index=False)
 
 # In this section, I am going to calculate the utilization percentage of bicycles and also assess the cost and benefit of the bike-sharing company. For this purpose, I have made a rough estimation of bicycle maintenance costs and the revenue from each bike based on the trip duration. This is just a simple simulation of this kind of analysis.
 
-# Working on the last year of data 2019
-import pandas as pd
-df_MM_clean_2019 = pd.read_csv('dataframe_2019 (1).csv', on_bad_lines = 'warn', sep=',')
-
-# Create datetime from "START TIME", "STOP TIME"
-df_MM_clean_2019['START TIME'] = pd.to_datetime(df_MM_clean_2019['START TIME'])
-df_MM_clean_2019['STOP TIME'] = pd.to_datetime(df_MM_clean_2019['STOP TIME'])
-
-# Geoup by "BIKE ID"
-group_bikes = df_MM_clean_2019.groupby("BIKE ID").agg({"TRIP DURATION": "sum",
-                                                      "START TIME": "min",
-                                                      "STOP TIME": "max"})
+# The utilization is computed by sorting the trips by (BIKE ID, START TIME) once and reducing every bike (or every bike and
+# calendar bucket) with segmented NumPy reductions. The time that a bike is busy is the union of its trip intervals, so
+# overlapping trips (which are data errors) are detected and not counted twice.
+
+# Function for the calendar bucket of each epoch second: 'day', 'week' (starting on Monday), 'dow' (day of week), 'month' or None (one bucket)
+# It returns the integer bucket of every value and a function that turns buckets into readable labels.
+def calendar_buckets(seconds, bucket=None):
+    days = seconds // 86400
+    if bucket is None:
+        return np.zeros(len(seconds), dtype='int64'), lambda buckets: buckets
+    if bucket == 'day':
+        return days, lambda buckets: buckets.astype('datetime64[D]')
+    if bucket == 'week':
+        # 1970-01-01 was a Thursday, so the weeks are shifted by 3 days to start on Monday
+        return (days + 3) // 7, lambda buckets: (buckets * 7 - 3).astype('datetime64[D]')
+    if bucket == 'dow':
+        return (days + 3) % 7, lambda buckets: pd.Categorical.from_codes(buckets, DAYS_OF_WEEK)
+    if bucket == 'month':
+        return days.astype('datetime64[D]').astype('datetime64[M]').astype('int64'), lambda buckets: buckets.astype('datetime64[M]')
+    raise ValueError(f"Unknown calendar bucket: {bucket}")
+
+BUCKET_NAMES = {'day': 'DAY', 'week': 'WEEK', 'dow': 'DAY OF WEEK', 'month': 'MONTH'}
+
+# Function for the utilization of each bike (and calendar bucket) from its trips ("BIKE ID", "START TIME", "STOP TIME", "TRIP DURATION")
+# The times are in minutes: TRIP DURATION is the sum of the trip durations, BUSY TIME the union of the trip intervals, IDLE TIME
+# the gaps between them and ACTIVE TIME the time from the first start to the last stop. The trips belong to the bucket of their start.
+def bike_utilization(df, bucket=None):
+    bikes = df["BIKE ID"].to_numpy()
+    start = epoch_seconds(df["START TIME"])
+    stop = epoch_seconds(df["STOP TIME"])
+    buckets, bucket_labels = calendar_buckets(start, bucket)
+
+    order = np.lexsort((start, buckets, bikes))
+    bikes, buckets, start, stop = bikes[order], buckets[order], start[order], stop[order]
+    duration = df["TRIP DURATION"].to_numpy(dtype='float64')[order]
+
+    # Segments of trips of the same bike (and bucket)
+    new_segment = np.r_[True, (bikes[1:] != bikes[:-1]) | (buckets[1:] != buckets[:-1])]
+    segment_starts = np.flatnonzero(new_segment)
+    segments = np.cumsum(new_segment) - 1
+
+    # Latest stop of the previous trips of the same segment: a running maximum that restarts at each segment
+    # (each segment is shifted above the previous one, so one accumulate over all the trips is enough)
+    first_time = min(start.min(), stop.min())
+    span = max(start.max(), stop.max()) - first_time + 1
+    covered_until = np.maximum.accumulate(stop - first_time + segments * span) - segments * span + first_time
+    previous_cover = np.r_[first_time, covered_until[:-1]]
+    previous_cover[segment_starts] = start[segment_starts]
+
+    busy = np.maximum(stop - np.maximum(start, previous_cover), 0)
+    idle = np.maximum(start - previous_cover, 0)
+    overlapping = start < previous_cover
+
+    first_start = start[segment_starts]
+    last_stop = np.maximum.reduceat(stop, segment_starts)
+    active = last_stop - first_start
+
+    index_values = [bikes[segment_starts]]
+    index_names = ["BIKE ID"]
+    if bucket is not None:
+        index_values.append(bucket_labels(buckets[segment_starts]))
+        index_names.append(BUCKET_NAMES[bucket])
+
+    utilization = pd.DataFrame({
+        "TRIPS": np.diff(np.r_[segment_starts, len(start)]),
+        "TRIP DURATION": np.add.reduceat(duration, segment_starts),
+        "START TIME": first_start.astype('datetime64[s]'),
+        "STOP TIME": last_stop.astype('datetime64[s]'),
+        "BUSY TIME": np.add.reduceat(busy, segment_starts) / 60,
+        "IDLE TIME": np.add.reduceat(idle, segment_starts) / 60,
+        "ACTIVE TIME": active / 60,
+        "OVERLAPPING TRIPS": np.add.reduceat(overlapping, segment_starts),
+    }, index=pd.MultiIndex.from_arrays(index_values, names=index_names) if bucket is not None else pd.Index(index_values[0], name="BIKE ID"))
+
+    # Calculate the utilization percentage (no utilization for the bikes/buckets with only instantaneous trips)
+    utilization["utilization_percentage"] = utilization["BUSY TIME"] / utilization["ACTIVE TIME"].where(utilization["ACTIVE TIME"] > 0) * 100
+    return utilization
+
+# Working on the last year of data 2019 (a view of the trip store, with the timestamps already parsed)
+df_MM_clean_2019 = trip_columns.where(trip_columns.array("YEAR") == 2019).frame(TRIP_COLUMNS["utilization"])
+
+# Geoup by "BIKE ID" (a copy of the stage output, because columns are added to it below)
+group_bikes = stage_cache("utilization", bike_utilization, df_MM_clean_2019).copy()
 
 # Convert from seconds to minutes
 group_bikes["TRIP DURATION (MINUTES)"] = group_bikes["TRIP DURATION"]/60
@@ -1089,14 +2223,13 @@ group_bikes["TRIP DURATION (MINUTES)"] = group_bikes["TRIP DURATION"]/60
 # Calculate the revenue
 group_bikes["REVENUE (USD)"] = group_bikes["TRIP DURATION (MINUTES)"] * 0.17
 
-# Calculate the total time that each bicycle exists on the streets
-group_bikes["ACTIVE TIME"] = (group_bikes["STOP TIME"] - group_bikes["START TIME"]).dt.total_seconds() / 60
-
-# Calculate the utilization percentage of each bike
-group_bikes["utilization_percentage"] = ((group_bikes["TRIP DURATION (MINUTES)"] / group_bikes["ACTIVE TIME"]) * 100)
-
+# The total time that each bicycle exists on the streets ("ACTIVE TIME") and the utilization percentage of each bike
+# are computed by bike_utilization, together with the busy and idle times and the number of overlapping trips.
 group_bikes.head()
 
+# Bikes with overlapping trips
+group_bikes[group_bikes["OVERLAPPING TRIPS"] > 0]
+
 group_bikes["utilization_percentage"].mean()
 # The average of utilization percentage of bikes is about 3.8%.
 
@@ -1136,25 +2269,150 @@ print(f'the interest in 2019 is {interest}')
 
 # ...........................................................................................
 
+# Rebalancing: the yearly number of start and end trips per ward does not show the imbalance within a day, e.g. a station
+# that is emptied every morning and filled every evening. So for every station and day, the trips are turned into events
+# (-1 bike at the start of a trip at its FROM station, +1 at the stop at its TO station), sorted by (station, day, time), and the
+# cumulative sum of each (station, day) gives the curve of the number of bikes gained or lost since midnight:
+# - PEAK DEFICIT: the most bikes lost at any time of the day (the bikes that the station needs in the morning),
+# - PEAK SURPLUS: the most bikes gained (the free docks that it needs),
+# - NET FLOW: the bikes gained at the end of the day,
+# - REBALANCING MOVES = PEAK DEFICIT + PEAK SURPLUS: the bikes brought to or taken from the station by truck so that it never
+#   runs out of bikes or docks during the day. A station emptied every morning and filled every evening has no net flow but
+#   still needs its peak deficit; the moves are never fewer than |NET FLOW|, which only brings the station back to its level
+#   of the morning.
+def station_day_balance(trips):
+    stations = np.union1d(trips["FROM STATION ID"].to_numpy(), trips["TO STATION ID"].to_numpy())
+    times = np.concatenate([epoch_seconds(trips["START TIME"]), epoch_seconds(trips["STOP TIME"])])
+    station_codes = np.concatenate([zone_codes(trips["FROM STATION ID"], stations), zone_codes(trips["TO STATION ID"], stations)])
+    deltas = np.repeat(np.array([-1, 1], dtype='int32'), len(times) // 2)
+
+    days = times // 86400
+    first_day = days.min()
+    segments = station_codes * (days.max() - first_day + 1) + (days - first_day)
+    # Sorted by segment and time (arrivals before departures at the same second), on one integer key
+    order = np.argsort((segments * 86400 + times % 86400) * 2 + (deltas < 0))
+    segments, deltas = segments[order], deltas[order]
+
+    segment_starts = np.flatnonzero(np.r_[True, segments[1:] != segments[:-1]])
+    segment_ends = np.r_[segment_starts[1:], len(segments)] - 1
+    cumulative = np.cumsum(deltas)
+    curve = cumulative - np.repeat(cumulative[segment_starts] - deltas[segment_starts], np.diff(np.r_[segment_starts, len(segments)]))
+
+    n_days = days.max() - first_day + 1
+    segment_keys = segments[segment_starts]
+    net_flow = curve[segment_ends]
+    balance = pd.DataFrame({
+        "DEPARTURES": np.add.reduceat((deltas < 0).astype('int32'), segment_starts),
+        "ARRIVALS": np.add.reduceat((deltas > 0).astype('int32'), segment_starts),
+        "NET FLOW": net_flow.astype('int32'),
+        "PEAK DEFICIT": np.maximum(-np.minimum.reduceat(curve, segment_starts), 0).astype('int32'),
+        "PEAK SURPLUS": np.maximum(np.maximum.reduceat(curve, segment_starts), 0).astype('int32'),
+    }, index=pd.MultiIndex.from_arrays([stations[segment_keys // n_days],
+                                        ((first_day + segment_keys % n_days) * 86400).astype('datetime64[s]')],
+                                       names=["STATION ID", "DAY"]))
+    balance["REBALANCING MOVES"] = balance["PEAK DEFICIT"] + balance["PEAK SURPLUS"]
+    return balance
+
+# Station balance of every day of 2019 (from its view of the trip store)
+station_days_2019 = stage_cache("station balance", station_day_balance, trip_columns.where(trip_columns.array("YEAR") == 2019))
+station_days_2019.sort_values("PEAK DEFICIT", ascending=False).head()
+
+# Every truck move takes a bike from a station with a surplus to a station with a deficit, so the bikes moved in a day are the
+# largest of the total peak surplus and the total peak deficit of the stations
+daily_surplus = station_days_2019["PEAK SURPLUS"].groupby(level="DAY").sum()
+daily_deficit = station_days_2019["PEAK DEFICIT"].groupby(level="DAY").sum()
+daily_moves = np.maximum(daily_surplus, daily_deficit).rename("REBALANCING MOVES")
+daily_moves.describe()
+
+# For comparison, the moves that only bring every station back to its level of the morning (from the net flows)
+daily_net_surplus = station_days_2019["NET FLOW"].clip(lower=0).groupby(level="DAY").sum()
+daily_net_deficit = (-station_days_2019["NET FLOW"]).clip(lower=0).groupby(level="DAY").sum()
+daily_net_moves = np.maximum(daily_net_surplus, daily_net_deficit).rename("NET FLOW MOVES")
+print(f'rebalancing moves in 2019: {daily_moves.sum()} from the peaks, {daily_net_moves.sum()} from the net flows')
+
+# Cost of moving one bike by truck (USD)
+rebalancing_per_bike = 3
+
+total_rebalancing_cost = daily_moves.sum() * rebalancing_per_bike
+print(f'the rebalancing cost in 2019 is {total_rebalancing_cost}')
+
+interest_after_rebalancing = interest - total_rebalancing_cost
+print(f'the interest in 2019 after rebalancing is {interest_after_rebalancing}')
+
+# ...........................................................................................
+
+# Bike trajectories: the trips of every bike, sorted by (BIKE ID, START TIME) as for the utilization, form a chain in which
+# each trip should start at the station where the previous one stopped. Each pair of consecutive trips of a bike is a link:
+# - TELEPORT: the bike left from another station than the one where it arrived, so it was moved in between (rebalancing by
+#   truck, repair) or the data is wrong,
+# - OVERLAP: the next trip started before the previous one stopped (a data error),
+# - DWELL TIME: the minutes that the bike stayed docked between the two trips (at its arrival station when it is not a teleport).
+# The links are computed with comparisons of the sorted arrays shifted by one trip, as a compact columnar table.
+def bike_links(trips):
+    bikes = trips["BIKE ID"].to_numpy()
+    start = epoch_seconds(trips["START TIME"])
+    stop = epoch_seconds(trips["STOP TIME"])
+
+    order = np.lexsort((start, bikes))
+    bikes, start, stop = bikes[order], start[order], stop[order]
+    from_stations = trips["FROM STATION ID"].to_numpy()[order]
+    to_stations = trips["TO STATION ID"].to_numpy()[order]
+
+    # Every trip (except the last one of each bike) is linked to the next trip of the same bike
+    previous = np.flatnonzero(bikes[1:] == bikes[:-1])
+    following = previous + 1
+    links = pd.DataFrame({
+        "BIKE ID": bikes[following],
+        "ARRIVAL TIME": stop[previous].astype('datetime64[s]'),
+        "ARRIVAL STATION": to_stations[previous],
+        "DEPARTURE TIME": start[following].astype('datetime64[s]'),
+        "DEPARTURE STATION": from_stations[following],
+        "DWELL TIME": ((start[following] - stop[previous]) / 60).astype('float32'),
+    })
+    links["TELEPORT"] = to_stations[previous] != from_stations[following]
+    links["OVERLAP"] = start[following] < stop[previous]
+    return links
+
+# Function for the dwell time (minutes) of the bikes at each station, from the links where the bike stayed at its arrival station
+def station_dwell(links):
+    stays = links[~(links["TELEPORT"] | links["OVERLAP"])]
+    dwell = stays.groupby("ARRIVAL STATION")["DWELL TIME"].agg(["size", "mean", "median", "max"])
+    dwell.columns = ["STAYS", "MEAN DWELL TIME", "MEDIAN DWELL TIME", "MAX DWELL TIME"]
+    return dwell.rename_axis("STATION ID")
+
+# Links of the bikes in 2019 (from the view of the trip store)
+bike_links_2019 = stage_cache("bike links", bike_links, trip_columns.where(trip_columns.array("YEAR") == 2019))
+bike_links_2019[["TELEPORT", "OVERLAP"]].sum()
+
+# Teleports and overlaps of each bike
+bike_links_2019.groupby("BIKE ID")[["TELEPORT", "OVERLAP"]].sum().sort_values("TELEPORT", ascending=False).head()
+
+# The bikes that were moved between stations: the OD matrix of the teleports (from the arrival station to the next departure station)
+# is the observed rebalancing, to be compared with the moves estimated from the peaks and the net flows of the stations above
+teleports_2019 = bike_links_2019[bike_links_2019["TELEPORT"]]
+rebalancing_od_2019 = sparse_od_matrices(teleports_2019, zones=np.union1d(teleports_2019["ARRIVAL STATION"], teleports_2019["DEPARTURE STATION"]),
+                                         origin="ARRIVAL STATION", destination="DEPARTURE STATION")[()]
+print(f'observed moves in 2019: {rebalancing_od_2019.total()}, estimated from the peaks: {daily_moves.sum()}, '
+      f'from the net flows: {daily_net_moves.sum()}')
+rebalancing_od_2019.top_flows(10)
+
+# The stations where the bikes stay docked the longest
+station_dwell(bike_links_2019).sort_values("MEDIAN DWELL TIME", ascending=False).head(10)
+
+# ...........................................................................................
+
 # During different day of week
-group_bikes_week = df_MM_clean_2019.groupby(["BIKE ID", "Day_of_Week"]).agg({"TRIP DURATION": "sum",
-                                                                          "START TIME": "min",
-                                                                          "STOP TIME": "max"})
+# The active time and the utilization percentage of each bike in each day of week
+group_bikes_week = stage_cache("utilization", bike_utilization, df_MM_clean_2019, bucket='dow').copy()
 
 # Convert from seconds to minutes
 group_bikes_week["TRIP DURATION (MINUTES)"] = group_bikes_week["TRIP DURATION"]/60
 
-# Calculate the total time that each bicycle exists on the streets in each day of week
-group_bikes_week["ACTIVE TIME"] = (group_bikes_week["STOP TIME"] - group_bikes_week["START TIME"]).dt.total_seconds() / 60
-
-# Calculate the utilization percentage of each bike in each day of week
-group_bikes_week["utilization_percentage"] = ((group_bikes_week["TRIP DURATION (MINUTES)"] / group_bikes_week["ACTIVE TIME"]) * 100)
-
 group_bikes_week.head(14)
 
 group_bikes_week.sort_values('utilization_percentage', ascending=False).head()
 
-week_days = group_bikes_week.groupby("Day_of_Week").agg({"utilization_percentage": "mean"})
+week_days = group_bikes_week.groupby("DAY OF WEEK", observed=True).agg({"utilization_percentage": "mean"})
 
 week_days.head(7)
 # It shows that the average of utilization of bikes was more on weekends.
@@ -1163,7 +2421,7 @@ week_days.head(7)
 # The bar plot of average of utilization percentage within each day of week:
 bp_week_days = week_days.plot(kind = "bar")
 
-week_days_median = group_bikes_week.groupby("Day_of_Week").agg({"utilization_percentage": "median"})
+week_days_median = group_bikes_week.groupby("DAY OF WEEK", observed=True).agg({"utilization_percentage": "median"})
 
 week_days_median.head(7)
 
@@ -1171,4 +2429,23 @@ group_bikes.to_csv("group_bikes_2019_2", index=False)
 
 group_bikes_week.to_csv("group_bikes_week_2019_2", index=False)
 
+# ...........................................................................................
+
+# Daily utilization of the whole fleet for all the years
+# Every year is computed by a worker process from its view of the trip store (the days of a year only have trips of that year)
+def _view_utilization(view, bucket):
+    return bike_utilization(view.frame(TRIP_COLUMNS["utilization"]), bucket=bucket)
+
+def fleet_utilization(trips, bucket='day', workers=None):
+    trip_years = trips.array("YEAR")
+    views = [trips.where(trip_years == year) for year in np.unique(trip_years)]
+    context = multiprocessing.get_context("fork") if "fork" in multiprocessing.get_all_start_methods() else None
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+        return pd.concat(pool.map(_view_utilization, views, [bucket] * len(views)))
+
+fleet_daily = stage_cache("utilization", fleet_utilization, trip_columns, bucket='day')
+fleet_daily = fleet_daily.groupby(level="DAY")[["BUSY TIME", "ACTIVE TIME"]].sum()
+fleet_daily["utilization_percentage"] = fleet_daily["BUSY TIME"] / fleet_daily["ACTIVE TIME"] * 100
+bp_fleet_daily = fleet_daily["utilization_percentage"].plot(figsize=(30, 10))
+
 # This is the end of this Analysis. More analysis can be done in further efforts.